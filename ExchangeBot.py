@@ -1,17 +1,27 @@
 # Import libraries
 import telegram
 import logging
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
+from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, \
+	CallbackQueryHandler
 import functions
+import metrics
+import scanner
+import tracing
+import workers
 
 # Main code
 def main():
 
-	# Initiate logging module
+	# Initiate logging module, every message is tagged with the id of the
+	# command it was logged for. Set EXCHANGEBOT_LOG_LEVEL=DEBUG to also log
+	# cache lookups and timed spans.
 	logging.basicConfig(
-		format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-		level=logging.INFO
+		format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] ' +
+		'%(message)s',
+		level=tracing.LOG_LEVEL
 	)
+	for handler in logging.getLogger().handlers:
+		handler.addFilter(tracing.RequestIdFilter())
 
 	# Retrieve token from external file, enter the location of token.txt
 	# Token.txt should only contain 1 line which is the api token of your bot.
@@ -26,36 +36,113 @@ def main():
 	dispatcher = updater.dispatcher
 	jqueue = updater.job_queue
 
+	# Load the databases and caches saved by the last run so that commands can
+	# be served while the first automatic update is running
+	functions.loadSnapshot()
+
+	# Load the Telegram user ids allowed to run /stats from admins.txt, one id
+	# per line
+	functions.loadAdmins()
+
 	# Scheduled jobs
-	# Automatically updates the coin DB every 6 hours
+	# Automatically updates the coin DB every 6 hours, set
+	# EXCHANGEBOT_DB_INTERVAL to change it
 	job_updateCoinDB = jqueue.run_repeating(functions.autoUpdateDBWrapper,
-											interval=21600,
+											interval=functions.DB_UPDATE_INTERVAL,
 											first =0
 											)
 	job_updateCoinDB.enabled = True
+
+	# Writes the metrics for Prometheus every minute
+	job_writeMetrics = jqueue.run_repeating(functions.writeMetricsWrapper,
+											interval=60,
+											first=60
+											)
+	job_writeMetrics.enabled = True
+
+	# Deletes the history that is too old or over its size limit once a day
+	job_pruneHistory = jqueue.run_repeating(functions.pruneHistoryWrapper,
+											interval=functions.HISTORY_PRUNE_INTERVAL,
+											first=300
+											)
+	job_pruneHistory.enabled = True
+
+	# Crawls the markets of every coin from the all exchanges volume page
+	# every 5 minutes so most coins need no download of their own
+	job_crawl = jqueue.run_repeating(functions.crawlWrapper,
+									interval=functions.CRAWL_INTERVAL,
+									first=30
+									)
+	job_crawl.enabled = True
+
+	# Scans every coin for accumulation every 6 hours, starting after the
+	# first DB update
+	job_scan = jqueue.run_repeating(functions.autoScanWrapper,
+									interval=scanner.SCAN_INTERVAL,
+									first=600
+									)
+	job_scan.enabled = True
 	
-	# Creating command handlers
+	# Creating command handlers, every command is timed, logged with a request
+	# id and profiled at the rate set with /profile. Commands that scrape run on
+	# the worker pool so that the dispatcher thread is never blocked.
+	def instrument(command, handler):
+		return workers.offloadCommand(command,
+									  tracing.traceCommand(
+										  command,
+										  metrics.timeCommand(command,
+															  handler)))
+
 	updateDB_handler = CommandHandler('updateDB',
-									  functions.manualUpdateDBWrapper
+									  instrument(
+										  'updateDB',
+										  functions.manualUpdateDBWrapper)
 									  )
 	coin_handler = CommandHandler('c',
-								  functions.coinWrapper,
+								  instrument('c', functions.coinWrapper),
 								  pass_args=True
 								  )
 	cheapest_handler = CommandHandler('min',
-									  functions.cheapestWrapper,
+									  instrument(
+										  'min', functions.cheapestWrapper),
 									  pass_args=True
 									  )
 	expensive_handler = CommandHandler('max',
-									   functions.expensiveWrapper,
+									   instrument(
+										   'max', functions.expensiveWrapper),
 									   pass_args=True)
 	exchange_handler = CommandHandler('e',
-									  functions.exchangeWrapper,
+									  instrument(
+										  'e', functions.exchangeWrapper),
 									  pass_args=True
 									  )
+	analyse_handler = CommandHandler('analyse',
+									 instrument(
+										 'analyse', functions.analyseWrapper),
+									 pass_args=True
+									 )
+	diff_handler = CommandHandler('diff',
+								  instrument('diff', functions.diffWrapper),
+								  pass_args=True
+								  )
+	scan_handler = CommandHandler('scan',
+								  instrument('scan', functions.scanWrapper)
+								  )
 	start_handler = CommandHandler('start',
 								   functions.startWrapper
 								   )
+	stats_handler = CommandHandler('stats',
+								   functions.statsWrapper
+								   )
+	# The previous / next buttons of paginated replies are answered from the
+	# rendered replies cache without scraping
+	page_handler = CallbackQueryHandler(functions.pageWrapper,
+										pattern='^page:'
+										)
+	profile_handler = CommandHandler('profile',
+									 functions.profileWrapper,
+									 pass_args=True
+									 )
 
 
 	# Adding the handlers to the dispatcher
@@ -64,7 +151,13 @@ def main():
 	dispatcher.add_handler(expensive_handler)
 	dispatcher.add_handler(cheapest_handler)
 	dispatcher.add_handler(exchange_handler)
+	dispatcher.add_handler(analyse_handler)
+	dispatcher.add_handler(scan_handler)
+	dispatcher.add_handler(diff_handler)
 	dispatcher.add_handler(start_handler)
+	dispatcher.add_handler(stats_handler)
+	dispatcher.add_handler(profile_handler)
+	dispatcher.add_handler(page_handler)
 
 	# Disabled the following handlers
 
@@ -79,14 +172,8 @@ def main():
 	# dispatcher.add_handler(updateCache_handler)
 	# dispatcher.add_handler(unknown_handler)
 
-	# WIP functions
-	# analyse_handler = CommandHandler('analyse',
-	# 								 functions.analyseWrapper,
-	# 								 pass_args=True)
-	# dispatcher.add_handler(analyse_handler)
-
 	# Start the bot
-	print('starting bot!')
+	logging.getLogger(__name__).info('starting bot')
 	updater.start_polling(clean=True)
 
 
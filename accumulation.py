@@ -0,0 +1,122 @@
+import datetime
+import math
+import re
+
+import numpy as np
+
+import extractor
+
+# Accumulation factor of a coin from its daily open, high, low, close and
+# volume (see Notes.txt). A day's factor is its % change in volume divided by
+# its % change in price, so volume growing while the price barely moves gives a
+# large factor. Every function works on whole arrays at once.
+
+# Most recent days averaged by the trailing factor
+TRAILING_DAYS = 7
+
+# Class to represent the daily OHLCV history of a coin, oldest day first
+class History:
+
+    def __init__(self, dates, open, high, low, close, volume):
+        self.dates = dates
+        self.open = np.asarray(open, dtype=np.float64)
+        self.high = np.asarray(high, dtype=np.float64)
+        self.low = np.asarray(low, dtype=np.float64)
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.dates)
+
+def parseNumber(text):
+    text = re.sub(r'[^\d\.]', '', text)
+    return float(text) if text else np.nan
+
+# Builds a History from the (date, open, high, low, close, volume) text rows of
+# the CMC historical data table, which lists the newest day first
+def fromRows(rows):
+    rows = rows[::-1]
+    values = np.array([[parseNumber(cell) for cell in row[1:6]]
+                       for row in rows], dtype=np.float64).reshape(-1, 5)
+    dates = [datetime.datetime.strptime(row[0].strip(), '%b %d, %Y').date()
+             for row in rows]
+    return History(dates, values[:, 0], values[:, 1], values[:, 2],
+                   values[:, 3], values[:, 4])
+
+# Builds a History from the (start, open, high, low, close, volume) bars of
+# history.HistoryStore.ohlcv
+def fromBars(bars):
+    values = np.array([bar[1:6] for bar in bars],
+                      dtype=np.float64).reshape(-1, 5)
+    dates = [datetime.datetime.utcfromtimestamp(bar[0]).date()
+             for bar in bars]
+    return History(dates, values[:, 0], values[:, 1], values[:, 2],
+                   values[:, 3], values[:, 4])
+
+# Returns the % change of values from before to after. Changes from 0 are nan.
+def percentChange(before, after):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(before != 0, (after - before) / before, np.nan)
+
+# Returns the factor of every day after the first: the % change in volume from
+# the previous day over the % change in price from open to close. Days where
+# the price did not move are nan.
+def dailyFactors(history):
+    volume = percentChange(history.volume[:-1], history.volume[1:])
+    price = percentChange(history.open[1:], history.close[1:])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = np.where(price != 0, volume / price, np.nan)
+    factors[~np.isfinite(factors)] = np.nan
+    return factors
+
+# Returns the mean of the finite values, nan if there are none
+def meanOf(values, finite):
+    count = int(finite.sum())
+    return float(values[finite].sum()) / count if count else math.nan
+
+# Returns a dict with the factor over the whole history, the mean daily factor,
+# the mean daily factor of the last trailing days and their absolute variants.
+# The absolute variants also count accumulation while the price drifts down.
+def analyse(history, trailing=TRAILING_DAYS):
+    results = {'days': len(history)}
+    if len(history) < 2:
+        return results
+
+    # Plain floats, numpy is slower than Python for single values
+    first_volume = float(history.volume[0])
+    first_open = float(history.open[0])
+    volume = (float(history.volume[-1]) - first_volume) / first_volume \
+        if first_volume else math.nan
+    price = (float(history.close[-1]) - first_open) / first_open \
+        if first_open else math.nan
+    results['factor'] = volume / price if price else math.nan
+
+    factors = dailyFactors(history)
+    finite = np.isfinite(factors)
+    window = min(trailing, len(factors))
+    for suffix, values in (('', factors), ('_abs', np.abs(factors))):
+        results['mean' + suffix] = meanOf(values, finite)
+        results['trailing' + suffix] = meanOf(values[-window:],
+                                              finite[-window:])
+    results['trailing_days'] = window
+    results['price_change'] = float(price)
+    results['volume_change'] = float(volume)
+    return results
+
+# Parses and analyses the historical data pages of (coin, html) pairs. Returns
+# the (coin, analyse results) pairs of the pages that could be analysed and the
+# number of pages that could not. Runs in the worker processes of the scanner
+# so it only uses modules that are cheap to import.
+def analysePages(pages):
+    results = []
+    errors = 0
+    for coin, html in pages:
+        if not html:
+            errors = errors + 1
+            continue
+        try:
+            rows = extractor.extractHistory(html)
+            results.append((coin, analyse(fromRows(rows))))
+        except (ValueError, IndexError):
+            errors = errors + 1
+    return results, errors
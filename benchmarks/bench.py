@@ -0,0 +1,249 @@
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+
+# Offline benchmarks of the scrapers and parsers in functions.py. Requests to
+# CMC are answered from the versioned fixtures so runs are repeatable.
+#
+# Usage: python3 benchmarks/bench.py [--fixtures v1] [--repeat 5]
+#                                    [--threshold 0.2] [--save-baseline]
+#
+# Every benchmark reports the median time per call over repeat samples and the
+# peak memory allocated during one call. Results are compared against
+# baseline.json and the script exits with 1 if any benchmark is slower than the
+# baseline by more than threshold (0.2 = 20%). Baselines are machine specific,
+# save a new one before comparing changes on a different machine.
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import functions
+
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+
+# Class to represent a response of the fake HTTP layer
+class FixtureResponse:
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+        self.headers = dict()
+
+# Class to answer requests for CMC pages with the fixtures of one version
+class FixtureServer:
+
+    def __init__(self, version):
+        self.pages = dict()
+        folder = os.path.join(BENCH_DIR, 'fixtures', version)
+        for name in os.listdir(folder):
+            if name.endswith('.html.gz'):
+                with gzip.open(os.path.join(folder, name), 'rb') as f:
+                    self.pages[name[:-len('.html.gz')]] = f.read()
+
+    def get(self, url, **kwargs):
+        path = url[len(functions.CMC_URL):]
+        if path.startswith('/all/'):
+            name = 'all'
+        elif 'historical-data' in path:
+
+            # Every coin gets one of the history pages, always the same one
+            pages = sorted(name for name in self.pages
+                           if name.startswith('history_'))
+            name = pages[zlib.crc32(path.split('historical-data')[0]
+                                    .encode('utf-8')) % len(pages)]
+        elif path.startswith('/currencies/'):
+            name = 'markets_btc'
+        elif path.startswith('/exchanges/volume/'):
+            name = 'exchanges'
+        else:
+            name = 'exchange'
+        return FixtureResponse(self.pages[name])
+
+# Returns the median seconds per call of fn over repeat samples and the peak
+# bytes allocated by one call. Fast functions are called several times per
+# sample so that a sample takes at least MIN_SAMPLE seconds. setup runs before
+# every sample and is not timed.
+MIN_SAMPLE = 0.02
+
+def measure(fn, repeat, setup=None):
+    number = 1
+    while True:
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for i in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if setup or elapsed >= MIN_SAMPLE:
+            break
+        number = number * 10
+
+    times = [elapsed / number]
+    for i in range(repeat - 1):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for j in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return {'seconds': times[len(times) // 2], 'peak_bytes': peak}
+
+# Returns the benchmarks as a list of (name, fn, setup) tuples
+def getBenchmarks(server):
+    functions.updateCoinDB()
+
+    coins = dict()
+    functions.updateCoin('BTC', coins)
+    btc = coins['BTC'][0]
+
+    exchanges = dict()
+    functions.updateExchange('binance', exchanges)
+    binance = exchanges['binance'][3]
+
+    exchange_texts = [row.text.lower()
+                      for row in functions.extractor.extractExchangeVolumes(
+                          server.pages['exchanges'])
+                      if row.id != None]
+
+    history_page = server.pages['history_0']
+    snapshot = functions.getExchangeSnapshot()
+
+    def clearSnapshot():
+        functions.exchange_snapshot = None
+
+    return [
+        ('updateCoinDB',
+         lambda: functions.updateCoinDB(force=True), None),
+        ('updateCoin',
+         lambda: functions.updateCoin('BTC', dict()), None),
+        ('updateExchange (cold)',
+         lambda: functions.updateExchange('binance', dict()), clearSnapshot),
+        ('updateExchange (warm)',
+         lambda: functions.updateExchange('binance', dict()), None),
+        ('parseExchange min',
+         lambda: functions.parseExchange(btc, 'min'), None),
+        ('parseExchange max USD*',
+         lambda: functions.parseExchange(btc, 'max', 'USD*'), None),
+        ('parseCoin',
+         lambda: functions.parseCoin(binance), None),
+        ('MarketCrawl',
+         lambda: functions.MarketCrawl(snapshot, functions.databases.coins),
+         None),
+        ('analysePages',
+         lambda: functions.accumulation.analysePages([('BTC', history_page)]),
+         None),
+        ('getNameAndRank',
+         lambda: [functions.getNameAndRank(text) for text in exchange_texts],
+         None)
+    ]
+
+def run(version, repeat):
+    server = FixtureServer(version)
+    original_get = functions.httpclient.get
+    functions.httpclient.get = server.get
+    functions.history.store.enabled = False
+    results = dict()
+
+    try:
+        benchmarks = getBenchmarks(server)
+        for name, fn, setup in benchmarks:
+            results[name] = measure(fn, repeat, setup)
+    finally:
+        functions.httpclient.get = original_get
+        functions.history.store.enabled = True
+        functions.exchange_snapshot = None
+    return results
+
+# Prints results next to the baseline and returns the names of the benchmarks
+# that regressed by more than threshold
+def compare(results, baseline, threshold):
+    regressions = []
+    print('{:<26}{:>12}{:>12}{:>10}{:>14}'.format(
+        'benchmark', 'ms', 'base ms', 'change', 'peak KiB'))
+
+    for name in sorted(results):
+        seconds = results[name]['seconds']
+        line = '{:<26}{:>12.3f}'.format(name, seconds * 1000)
+        try:
+            base = baseline[name]['seconds']
+        except KeyError:
+            line = line + '{:>12}{:>10}'.format('-', '-')
+        else:
+            change = (seconds - base) / base if base > 0 else 0.0
+            line = line + '{:>12.3f}{:>+9.1f}%'.format(base * 1000,
+                                                       change * 100)
+            if change > threshold:
+                regressions.append(name)
+                line = line + ' !'
+        line = line + '{:>14.1f}'.format(results[name]['peak_bytes'] / 1024.0)
+        print(line)
+    return regressions
+
+def main(argv):
+    version = 'v1'
+    repeat = 5
+    threshold = 0.2
+    save = False
+
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--fixtures':
+            version = argv[i + 1]
+            i = i + 1
+        elif argv[i] == '--repeat':
+            repeat = int(argv[i + 1])
+            i = i + 1
+        elif argv[i] == '--threshold':
+            threshold = float(argv[i + 1])
+            i = i + 1
+        elif argv[i] == '--save-baseline':
+            save = True
+        else:
+            print("Unknown argument " + argv[i])
+            return 2
+        i = i + 1
+
+    results = run(version, repeat)
+
+    try:
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+    except IOError:
+        baseline = {'fixtures': version, 'results': {}}
+    if baseline.get('fixtures') != version:
+        print("Baseline was recorded with fixtures " +
+              str(baseline.get('fixtures')) + ", not comparing.")
+        baseline = {'fixtures': version, 'results': {}}
+
+    regressions = compare(results, baseline['results'], threshold)
+
+    if save:
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump({'fixtures': version, 'results': results}, f,
+                      indent=2, sort_keys=True)
+        print("Baseline saved to " + BASELINE_FILE)
+        return 0
+
+    if regressions:
+        print("Regressions over " + str(int(threshold * 100)) + "%: " +
+              ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,242 @@
+import gzip
+import math
+import os
+import random
+import sys
+import time
+
+# Generates the versioned HTML fixtures used by bench.py. The pages follow the
+# markup of the CMC pages the scrapers read and have roughly the size of the
+# live pages: ~1600 coins, a BTC sized markets page and ~200 exchanges.
+# Usage: python3 benchmarks/make_fixtures.py [version]
+
+COINS = 1600
+BTC_MARKETS = 6000
+EXCHANGES = 200
+
+# Number of different historical data pages and the days on each. bench.py
+# serves one of them to every coin.
+HISTORY_PAGES = 8
+HISTORY_DAYS = 365
+QUOTES = ['BTC', 'ETH', 'USDT', 'USD', 'TUSD', 'USDC', 'BNB', 'KRW', 'EUR',
+          'JPY', 'PAX', 'DAI']
+
+def slug(name):
+    return name.lower().replace(' ', '-').replace('.', '-')
+
+def money(value):
+    return '$' + format(value, ',')
+
+def allCoinsPage(coins):
+    rows = []
+    for rank, (name, ticker) in enumerate(coins, 1):
+        rows.append(
+            '<tr id="id-%s" class="">\n'
+            '<td class="text-center">\n%d\n</td>\n'
+            '<td class="no-wrap currency-name" data-sort="%s">\n'
+            '<div class="s-s-%d currency-logo-sprite"></div>\n'
+            '<span class="currency-symbol visible-xs">'
+            '<a class="link-secondary" href="/currencies/%s/">%s</a></span>\n'
+            '<br class="visible-xs">\n'
+            '<a class="currency-name-container link-secondary" '
+            'href="/currencies/%s/">%s</a>\n'
+            '</td>\n'
+            '<td class="text-left col-symbol">%s</td>\n'
+            '<td class="no-wrap market-cap text-right" data-usd="%d">\n'
+            '%s\n</td>\n'
+            '<td class="no-wrap text-right" data-sort="%f">\n'
+            '<a href="/currencies/%s/#markets" class="price">%s</a>\n</td>\n'
+            '<td class="no-wrap text-right circulating-supply">\n'
+            '<span data-supply="%d">%s</span>\n</td>\n'
+            '<td class="no-wrap text-right">\n'
+            '<a href="/currencies/%s/#markets" class="volume">%s</a>\n</td>\n'
+            '<td class="no-wrap percent-change text-right">%.2f%%</td>\n'
+            '<td class="no-wrap percent-change text-right">%.2f%%</td>\n'
+            '<td class="no-wrap percent-change text-right">%.2f%%</td>\n'
+            '<td class="dropdown" data-more-options="true">\n'
+            '<button class="btn btn-transparent" type="button">...</button>\n'
+            '</td>\n'
+            '</tr>\n' % (
+                slug(name), rank, name, rank, slug(name), ticker, slug(name),
+                name, ticker, random.randint(10 ** 5, 10 ** 11),
+                money(random.randint(10 ** 5, 10 ** 11)),
+                random.uniform(0.0001, 7000), slug(name),
+                money(round(random.uniform(0.0001, 7000), 4)),
+                random.randint(10 ** 5, 10 ** 11),
+                format(random.randint(10 ** 5, 10 ** 11), ','),
+                slug(name), money(random.randint(1, 10 ** 9)),
+                random.uniform(-20, 20), random.uniform(-20, 20),
+                random.uniform(-20, 20)))
+    return ('<html><head><title>All Cryptocurrencies</title></head><body>\n'
+            '<div class="table-responsive compact-name-column">\n'
+            '<table class="table" id="currencies-all">\n'
+            '<thead>\n<tr>\n<th>#</th>\n<th>Name</th>\n<th>Symbol</th>\n'
+            '</tr>\n</thead>\n<tbody>\n' + ''.join(rows) +
+            '</tbody>\n</table>\n</div>\n</body></html>\n')
+
+def marketsPage(exchanges, count):
+    rows = []
+    for rank in range(1, count + 1):
+        exchange = random.choice(exchanges)
+        quote = random.choice(QUOTES)
+        rows.append(
+            '<tr role="row">\n'
+            '<td class="text-right">%d</td>\n'
+            '<td class="no-wrap">\n'
+            '<img src="/static/img/exchanges/16x16/%s.png" '
+            'class="logo-sprite" alt="%s">\n'
+            '<a class="link-secondary" href="/exchanges/%s/">%s</a>\n'
+            '</td>\n'
+            '<td><a href="https://%s.example/trade/BTC_%s" target="_blank" '
+            'rel="nofollow noopener" class="link-secondary">BTC/%s</a></td>\n'
+            '<td class="text-right">\n'
+            '<span class="volume" data-usd="1" data-btc="1">%s</span>\n'
+            '</td>\n'
+            '<td class="text-right">\n'
+            '<span class="price" data-usd="1" data-btc="1">%s</span>\n'
+            '</td>\n'
+            '<td class="text-right" data-sort="1">%.2f%%</td>\n'
+            '<td class="text-right">Recently</td>\n'
+            '</tr>\n' % (
+                rank, slug(exchange), exchange, slug(exchange), exchange,
+                slug(exchange), quote, quote,
+                money(random.randint(1, 10 ** 9)),
+                money(round(random.uniform(6000, 7000), 2)),
+                random.uniform(0, 10)))
+    return ('<html><body>\n'
+            '<table class="table no-border table-condensed" '
+            'id="markets-table">\n'
+            '<thead>\n<tr>\n<th>#</th>\n<th>Source</th>\n<th>Pair</th>\n'
+            '</tr>\n</thead>\n<tbody>\n' + ''.join(rows) +
+            '</tbody>\n</table>\n</body></html>\n')
+
+def exchangesPage(exchanges, coins):
+    rows = []
+    for rank, exchange in enumerate(exchanges, 1):
+        rows.append('<tr id="%s">\n<td colspan="6">\n'
+                    '<h3 class="volume-header">\n'
+                    '<a href="/exchanges/%s/">%d. %s</a>\n</h3>\n</td>\n</tr>\n'
+                    % (slug(exchange), slug(exchange), rank, exchange))
+        rows.append('<tr>\n<td><b>#</b></td>\n<td><b>Currency</b></td>\n'
+                    '<td><b>Pair</b></td>\n'
+                    '<td class="text-right"><b>Volume (24h)</b></td>\n'
+                    '<td class="text-right"><b>Price</b></td>\n'
+                    '<td class="text-right"><b>Volume (%)</b></td>\n</tr>\n')
+        pairs = random.randint(3, 100)
+        for number in range(1, pairs + 1):
+            name, ticker = random.choice(coins)
+            quote = random.choice(QUOTES)
+            rows.append(
+                '<tr>\n<td>%d</td>\n'
+                '<td><a class="link-secondary" href="/currencies/%s/">%s</a>'
+                '</td>\n'
+                '<td><a href="https://%s.example/%s_%s" target="_blank">'
+                '%s/%s</a></td>\n'
+                '<td class="text-right"><span class="volume" data-usd="1">'
+                '%s</span></td>\n'
+                '<td class="text-right"><span class="price" data-usd="1">'
+                '%s</span></td>\n'
+                '<td class="text-right">%.2f%%</td>\n</tr>\n' % (
+                    number, slug(name), name, slug(exchange), ticker, quote,
+                    ticker, quote, money(random.randint(1, 10 ** 8)),
+                    money(round(random.uniform(0.001, 7000), 4)),
+                    random.uniform(0, 100)))
+        if pairs > 10:
+            rows.append('<tr>\n<td colspan="6">'
+                        '<a href="/exchanges/%s/#markets">View More</a>'
+                        '</td>\n</tr>\n' % slug(exchange))
+        rows.append('<tr><td colspan="3">Total</td>\n'
+                    '<td class="text-right">%s</td>\n</tr>\n'
+                    % money(random.randint(1, 10 ** 9)))
+    return ('<html><body>\n<table class="table table-condensed border-top">\n' +
+            ''.join(rows) + '</table>\n</body></html>\n')
+
+def exchangePage():
+    return ('<html><body>\n<div class="row">\n'
+            '<div class="col-sm-8 bottom-margin-1x">\n'
+            '<span class="h2">$1,234,567,890</span>\n</div>\n'
+            '<ul class="list-unstyled">\n'
+            '<li><span class="glyphicon glyphicon-link"></span> '
+            '<a href="https://www.binance.com/" target="_blank">Website</a>'
+            '</li>\n<li>Twitter</li>\n</ul>\n</div>\n</body></html>\n')
+
+def historyPage(rng, days):
+    rows = []
+    price = rng.uniform(0.01, 7000)
+    volume = rng.randint(10 ** 5, 10 ** 10)
+
+    # Volume trend per day, some coins are accumulated and some are not
+    trend = rng.uniform(-0.003, 0.003)
+
+    # Newest day first like the CMC page, going back from 17 Oct 2018
+    date = 1539734400
+    for day in range(days):
+        open_price = price
+        close = open_price * rng.uniform(0.95, 1.05)
+        price = close / rng.uniform(0.95, 1.05)
+        volume = max(1, int(volume * math.exp(rng.uniform(-0.2, 0.2) -
+                                              trend)))
+        rows.append(
+            '<tr class="text-right">\n'
+            '<td class="text-left">%s</td>\n'
+            '<td data-format-fiat data-format-value="%f">%s</td>\n'
+            '<td data-format-fiat data-format-value="%f">%s</td>\n'
+            '<td data-format-fiat data-format-value="%f">%s</td>\n'
+            '<td data-format-fiat data-format-value="%f">%s</td>\n'
+            '<td data-format-market-cap data-format-value="%d">%s</td>\n'
+            '<td data-format-market-cap data-format-value="%d">%s</td>\n'
+            '</tr>\n' % (
+                time.strftime('%b %d, %Y', time.gmtime(date - day * 86400)),
+                open_price, format(round(open_price, 6), ','),
+                max(open_price, close) * 1.01,
+                format(round(max(open_price, close) * 1.01, 6), ','),
+                min(open_price, close) * 0.99,
+                format(round(min(open_price, close) * 0.99, 6), ','),
+                close, format(round(close, 6), ','),
+                volume, format(volume, ','),
+                volume * 20, format(volume * 20, ',')))
+    return ('<html><body>\n<div id="historical-data">\n'
+            '<div class="table-responsive">\n<table class="table">\n'
+            '<thead>\n<tr class="text-right">\n<th class="text-left">Date'
+            '</th>\n<th>Open*</th>\n<th>High</th>\n<th>Low</th>\n'
+            '<th>Close**</th>\n<th>Volume</th>\n<th>Market Cap</th>\n'
+            '</tr>\n</thead>\n<tbody>\n' + ''.join(rows) +
+            '</tbody>\n</table>\n</div>\n</div>\n</body></html>\n')
+
+def main(version):
+    random.seed(version)
+    coins = [('Bitcoin', 'BTC'), ('Ethereum', 'ETH'), ('Ripple', 'XRP'),
+             ('Cindicator', 'CND'), ('TRON', 'TRX')]
+    coins = coins + [('Coin %d' % i, 'C%d' % i)
+                     for i in range(COINS - len(coins))]
+    exchanges = ['Binance', 'OKEx', 'Huobi', 'Bitfinex', 'Binance DEX',
+                 'KuCoin', 'Gate.io', 'Coinbase Pro']
+    exchanges = exchanges + ['Exchange %d' % i
+                             for i in range(EXCHANGES - len(exchanges))]
+
+    pages = {'all.html': allCoinsPage(coins),
+             'markets_btc.html': marketsPage(exchanges, BTC_MARKETS),
+             'exchanges.html': exchangesPage(exchanges, coins),
+             'exchange.html': exchangePage()}
+
+    # The history pages have their own generator so that adding them left the
+    # other pages unchanged
+    rng = random.Random(version + '-history')
+    for i in range(HISTORY_PAGES):
+        pages['history_%d.html' % i] = historyPage(rng, HISTORY_DAYS)
+
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'fixtures', version)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for name, html in sorted(pages.items()):
+        path = os.path.join(folder, name + '.gz')
+
+        # mtime=0 keeps the output identical between runs
+        with open(path, 'wb') as raw:
+            with gzip.GzipFile(name, 'wb', 9, raw, mtime=0) as f:
+                f.write(html.encode('utf-8'))
+        print(path + ": " + str(len(html)) + " bytes")
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else 'v1')
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+import sys
+from html.parser import HTMLParser
+
+# Elements that never have an end tag
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+             'link', 'meta', 'param', 'source', 'track', 'wbr'}
+
+# Folder with the saved CMC pages and the rows expected from them
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+# Class to represent a table cell. children is a list of the direct child
+# elements of the cell, each with the structure [tag, attrs, text]. href is the
+# href of the first link anywhere in the cell.
+class Cell:
+    __slots__ = ('text', 'children', 'href')
+
+    def __init__(self):
+        self.text = ''
+        self.children = []
+        self.href = None
+
+# Class to represent a table row. section is 'thead', 'tbody' or None for rows
+# that are direct children of the table.
+class Row:
+    __slots__ = ('id', 'section', 'text', 'cells', 'href')
+
+    def __init__(self, id, section):
+        self.id = id
+        self.section = section
+        self.text = ''
+        self.cells = []
+        self.href = None
+
+# Streaming tokenizer that only keeps the rows of a single table. Nothing is
+# built for markup outside of the table.
+class TableExtractor(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.rows = []
+        self.section = None
+        self.row = None
+        self.cell = None
+
+        # Depth of the current element inside the current cell
+        self.depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ('thead', 'tbody', 'tfoot'):
+            self.section = tag
+        elif tag == 'tr':
+            self.row = Row(dict(attrs).get('id'), self.section)
+            self.rows.append(self.row)
+        elif tag in ('td', 'th') and self.row is not None:
+            self.cell = Cell()
+            self.row.cells.append(self.cell)
+            self.depth = 0
+        elif self.cell is not None:
+            attrs = dict(attrs)
+            if self.depth == 0:
+                self.cell.children.append([tag, attrs, ''])
+            if tag not in VOID_TAGS:
+                self.depth = self.depth + 1
+            if tag == 'a' and 'href' in attrs:
+                if self.cell.href is None:
+                    self.cell.href = attrs['href']
+                if self.row.href is None:
+                    self.row.href = attrs['href']
+
+    def handle_startendtag(self, tag, attrs):
+        if self.cell is not None and self.depth == 0:
+            self.cell.children.append([tag, dict(attrs), ''])
+
+    def handle_endtag(self, tag):
+        if tag in ('thead', 'tbody', 'tfoot'):
+            self.section = None
+        elif tag == 'tr':
+            self.row = None
+            self.cell = None
+        elif tag in ('td', 'th'):
+            self.cell = None
+        elif self.cell is not None and tag not in VOID_TAGS and self.depth > 0:
+            self.depth = self.depth - 1
+
+    def handle_data(self, data):
+        if self.row is not None:
+            self.row.text = self.row.text + data
+        if self.cell is not None:
+            self.cell.text = self.cell.text + data
+            if self.depth > 0:
+                self.cell.children[-1][2] = self.cell.children[-1][2] + data
+
+# Returns the rows of the first table whose opening tag matches pattern. Only
+# the markup of that table is tokenized.
+def extractTable(html, pattern):
+    if isinstance(html, bytes):
+        html = html.decode('utf-8', 'replace')
+
+    match = re.search(pattern, html)
+    if match is None:
+        return []
+    end = html.find('</table>', match.start())
+    if end == -1:
+        end = len(html)
+
+    extractor = TableExtractor()
+    extractor.feed(html[match.start():end])
+    extractor.close()
+    return extractor.rows
+
+# Returns the text of the index-th direct child element of cell
+def childText(cell, index):
+    return cell.children[index][2]
+
+# Returns the ticker, url path tuples of the all coins table
+def extractCoins(html):
+    rows = extractTable(html, r'<table[^>]*\bid="currencies-all"')
+    results = []
+
+    for row in rows:
+        if row.section != 'tbody':
+            continue
+
+        # The name cell holds the ticker in its second element and the link to
+        # the coin in its fourth element
+        cell = row.cells[1]
+        results.append((childText(cell, 1), cell.children[3][1]['href']))
+    return results
+
+# Returns the exchange name, trading pair, volume text, price text, url tuples
+# of a coin's markets table
+def extractMarkets(html):
+    rows = extractTable(html, r'<table[^>]*\bid="markets-table"')
+    results = []
+
+    for row in rows:
+        if row.section != 'tbody':
+            continue
+        cells = row.cells
+        results.append((childText(cells[1], 1),
+                        childText(cells[2], 0),
+                        childText(cells[3], 0),
+                        childText(cells[4], 0),
+                        cells[2].children[0][1]['href']))
+    return results
+
+# Returns every row of the all exchanges volume table in order. Exchange rows
+# are the ones with an id.
+def extractExchangeVolumes(html):
+    return extractTable(
+        html, r'<table[^>]*\bclass="table table-condensed border-top"')
+
+# Returns the rank, coin name, trading pair, volume text, price text, url tuple
+# of a trading pair row in the all exchanges volume table
+def exchangeVolumeRow(row):
+    cells = row.cells
+    return (cells[0].text,
+            cells[1].text,
+            cells[2].text,
+            cells[3].text,
+            cells[4].text,
+            cells[2].href)
+
+# Returns the date, open, high, low, close, volume text tuples of a coin's
+# historical data table, newest day first
+def extractHistory(html):
+    rows = extractTable(html, r'<div[^>]*\bid="historical-data"')
+    return [tuple(cell.text.strip() for cell in row.cells[:6])
+            for row in rows
+            if row.section == 'tbody' and len(row.cells) >= 6]
+
+# Compares the extractor output for the saved fixtures against the rows that
+# were recorded from the BeautifulSoup scrapers
+def checkFixtures(fixtures_dir=FIXTURES_DIR):
+    with open(os.path.join(fixtures_dir, 'expected.json')) as f:
+        expected = json.load(f)
+
+    def read(name):
+        with open(os.path.join(fixtures_dir, name), 'rb') as f:
+            return f.read()
+
+    results = {
+        'coins': extractCoins(read('all.html')),
+        'markets': extractMarkets(read('markets.html')),
+        'exchanges': [[row.id, row.text, row.href,
+                       exchangeVolumeRow(row) if len(row.cells) >= 5 else None]
+                      for row in extractExchangeVolumes(read('exchanges.html'))]
+    }
+
+    # Round trip through json so tuples compare equal to the saved lists
+    results = json.loads(json.dumps(results))
+    passed = True
+    for key in sorted(expected):
+        if results[key] != expected[key]:
+            print(key + " does not match the saved fixtures!")
+            passed = False
+        else:
+            print(key + " matches the saved fixtures.")
+    return passed
+
+if __name__ == "__main__":
+    sys.exit(0 if checkFixtures() else 1)
@@ -1,92 +1,983 @@
-import requests
+import accumulation
+import bisect
 import datetime
+import hashlib
+import heapq
+import history
+import logging
 import math
+import os
+import pickle
 import re
+import scanner
+import struct
+import sys
+import threading
 import time
+import zlib
+import extractor
+import httpclient
+import metrics
+import prefetch
+import tracing
+import workers
+from array import array
 from bs4 import BeautifulSoup
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from random import randint
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+logger = logging.getLogger(__name__)
+
+# Cache thresholds in seconds for coin_to_exchanges and exchange_to_coin. An
+# entry older than CACHE_SOFT_TTL is served as is while it is refreshed in the
+# background. Only an entry older than CACHE_HARD_TTL makes the caller wait for
+# the update. Set CACHE_HARD_TTL to CACHE_SOFT_TTL to always wait.
+CACHE_SOFT_TTL = 60
+CACHE_HARD_TTL = 600
+
+# Limits for each of coin_to_exchanges and exchange_to_coin. Once either limit
+# is exceeded the least recently used entries are evicted.
+CACHE_MAX_ENTRIES = 500
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Estimates the memory used by obj and everything it references
+def estimateSize(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size = size + estimateSize(key, seen) + estimateSize(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size = size + estimateSize(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size = size + estimateSize(obj.__dict__, seen)
+    elif hasattr(obj, '__slots__'):
+        for slot in obj.__slots__:
+            if hasattr(obj, slot):
+                size = size + estimateSize(getattr(obj, slot), seen)
+    return size
+
+# Class to represent a cache bounded by number of entries and estimated bytes.
+# Entries are evicted least recently used first and expire ttl seconds after
+# they are stored. Lookups with [] and in are counted in the statistics, peek
+# reads an entry without counting it or marking it as recently used.
+class BoundedCache:
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock = threading.RLock()
+
+        # key -> (value, size, time_of_insert), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def remove(self, key):
+        value, size, inserted = self.entries.pop(key)
+        self.bytes = self.bytes - size
+        return value
+
+    def expired(self, key):
+        return time.time() - self.entries[key][2] > self.ttl
+
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self.entries and self.expired(key):
+                self.remove(key)
+                self.expirations = self.expirations + 1
+            try:
+                value = self.entries[key][0]
+            except KeyError:
+                self.misses = self.misses + 1
+                raise
+            self.entries.move_to_end(key)
+            self.hits = self.hits + 1
+            return value
 
-# Initialize a dictionary of coin_ticker tuple pair.
-# tuple has the structure (dict of exchange_name coin pair, time_of_update)
-# coin has the structure total_vol, [{trading_pair, vol, price, url}]
-# sorted by highest cumulative trade volume 
-coin_to_exchanges = dict()
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
 
-# Initialize a coin_database of ticker url path pair. Updated every 6 hours
-coin_database = dict()
+    def __setitem__(self, key, value):
+        size = estimateSize(value)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (value, size, time.time())
+            self.bytes = self.bytes + size
 
-# Initialize an exchange_to_coin database of exchange_name tuple pair
-# tuple has the structure (exchange_rank, exchange_vol, exchange_url, coin,
-# time_of_update)
-# coin has the structure total_vol, [{coin_rank, coin_name, trading pair, vol, 
-# price, url, time of update}]
-# top 10 dict is a dict of coin volume pairs
-exchange_to_coin = dict()
+            # Evict least recently used entries but always keep the new one
+            while (len(self.entries) > 1 and
+                   (len(self.entries) > self.max_entries or
+                    self.bytes > self.max_bytes)):
+                self.remove(next(iter(self.entries)))
+                self.evictions = self.evictions + 1
 
-# Initialize a list of exchanges and the time of update. Updated every 3 hours.
-exchange_database = []
+    def __delitem__(self, key):
+        with self.lock:
+            self.remove(key)
 
-# Scrapes CMC's website to retrieve the URL path of coin based on the ticker
-# provided. 
-def updateCoinDB(coin_database):
+    def __len__(self):
+        return len(self.entries)
 
-    # Might want to include error handling just in case
-    print("Updating coin_database...")
-    page = requests.get("https://coinmarketcap.com/all/views/all/")
-    soup = BeautifulSoup(page.content, 'html.parser')
+    def __iter__(self):
+        return iter(self.keys())
 
-    # Get tbody
-    table = list(soup.find('table', id='currencies-all').children)  
-    tbody = list(table[3].children)
+    def peek(self, key):
+        with self.lock:
+            return self.entries[key][0]
 
-    # Get length
-    length = len(tbody)
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries.keys())
+
+    def items(self):
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
 
-    # Populating coin_database
-    i = 1
+# Initialize a dictionary of coin_ticker tuple pair.
+# tuple has the structure (MarketTable of exchanges, time_of_update, partial)
+# the MarketTable groups the trading pairs by exchange name and is sorted by
+# highest cumulative trade volume. partial is set for entries filled from the
+# market crawl, which only has the top pairs of most exchanges.
+coin_to_exchanges = BoundedCache(CACHE_MAX_ENTRIES,
+                                 CACHE_MAX_BYTES,
+                                 CACHE_HARD_TTL)
 
-    while(i < length):
-        entry = list(list(tbody[i].children)[3].children)
-        ticker = entry[3].get_text()
+# Base URL of every page scraped from CMC
+CMC_URL = 'https://coinmarketcap.com'
 
+# Initialize an exchange_to_coin database of exchange_name tuple pair
+# tuple has the structure (exchange_rank, exchange_vol, exchange_url, coins,
+# time_of_update)
+# coins is a MarketTable that groups the trading pairs by coin name and keeps
+# the coin rank of every trading pair
+exchange_to_coin = BoundedCache(CACHE_MAX_ENTRIES,
+                                CACHE_MAX_BYTES,
+                                CACHE_HARD_TTL)
+
+# Normalizes an exchange name for lookups e.g. "Binance DEX" -> "binancedex"
+def normalizeExchange(name):
+    return re.sub("[^0-9a-z]", "", name.lower())
+
+# Returns the set of trigrams of a normalized exchange name
+def getTrigrams(name):
+    padded = '$' + name + '$'
+    return set(padded[i:i + 3] for i in range(max(len(padded) - 2, 1)))
+
+# Class to represent the list of exchanges listed on CMC. Names are the ids
+# produced by getNameAndRank. Every name is reachable through a hash index of
+# its normalized name and its CMC url slug, and a trigram index is kept for
+# suggesting the closest exchanges when a name cannot be resolved.
+class ExchangeIndex:
+
+    def __init__(self, names=(), slugs=None):
+        self.rebuild(names, slugs)
+
+    # Replaces the exchanges with names. slugs is an optional dict of
+    # exchange_name CMC path pairs e.g.
+    # {'binancedex': '/exchanges/binance-dex/'}
+    def rebuild(self, names, slugs=None):
+        slugs = dict(slugs or {})
+        aliases = dict()
+        trigrams = dict()
+
+        for name in names:
+            keys = [name, normalizeExchange(name)]
+            if name in slugs:
+                slug = slugs[name].strip('/').split('/')[-1]
+                keys.append(slug)
+                keys.append(normalizeExchange(slug))
+            for key in keys:
+                aliases.setdefault(key, name)
+            for trigram in getTrigrams(normalizeExchange(name)):
+                trigrams.setdefault(trigram, set()).add(name)
+
+        self.names = list(names)
+        self.slugs = slugs
+        self.aliases = aliases
+        self.trigrams = trigrams
+
+    # Returns the exchange name for name or one of its aliases, None if it is
+    # not a known exchange
+    def resolve(self, name):
         try:
-            coin_database[ticker]
+            return self.aliases[name.lower()]
         except KeyError:
-            suffix = entry[7]['href']
-            coin_database[ticker] = suffix
-        finally:
-            i = i + 2
-    print("Update complete!")
+            return self.aliases.get(normalizeExchange(name))
+
+    # Returns up to limit exchange names closest to name, most similar first
+    def suggest(self, name, limit=3, threshold=0.2):
+        query = normalizeExchange(name)
+        if not query:
+            return []
+        query_trigrams = getTrigrams(query)
+
+        shared = dict()
+        for trigram in query_trigrams:
+            for candidate in self.trigrams.get(trigram, ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        scores = []
+        for candidate, count in shared.items():
+            normalized = normalizeExchange(candidate)
+            score = count / float(len(query_trigrams) +
+                                  len(getTrigrams(normalized)) - count)
+
+            # Names starting with the query are likely what was meant
+            if normalized.startswith(query):
+                score = score + 0.5
+            if score >= threshold:
+                scores.append((-score, candidate))
+        return [candidate for score, candidate in sorted(scores)[:limit]]
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+# Class to represent one published version of the databases. coins is the
+# coin database of ticker url path pairs, ranking the tuple of its tickers
+# ordered by CMC rank, exchanges the index of exchanges and changes the
+# changes made by the last update of each database. It is never changed once
+# published.
+class Databases:
+
+    def __init__(self, coins, ranking, exchanges, version=0, changes=None):
+        self.coins = coins
+        self.ranking = ranking
+        self.exchanges = exchanges
+        self.version = version
+        self.changes = changes or dict()
+
+# Initialize the databases. Updated every 6 hours by replacing them with new
+# ones in a single assignment, so a reader that takes databases once always
+# sees coins, ranking, exchanges and version from the same update.
+databases = Databases(dict(), (), ExchangeIndex())
+db_lock = threading.Lock()
+
+# Returns the added, removed and changed keys going from old to new dict
+def diffDatabase(old, new):
+    added = [key for key in new if key not in old]
+    removed = [key for key in old if key not in new]
+    changed = [key for key in new if key in old and old[key] != new[key]]
+    return {'added': len(added), 'removed': len(removed),
+            'changed': len(changed)}
+
+# Publishes new databases built off to the side. Readers that already hold
+# the old ones keep a consistent copy and new readers see the new ones, no
+# reader ever sees a database being built. Databases that are not given are
+# carried over. Returns the changes per database.
+def publishDatabases(coins=None, ranking=None, exchanges=None):
+    global databases
+    changes = dict()
+    with db_lock:
+        current = databases
+        if coins is not None:
+            changes['coins'] = diffDatabase(current.coins, coins)
+            ranking = tuple(ranking)
+        else:
+            coins = current.coins
+            ranking = current.ranking
+        if exchanges is not None:
+            changes['exchanges'] = diffDatabase(current.exchanges.slugs,
+                                                exchanges.slugs)
+        else:
+            exchanges = current.exchanges
+        latest = dict(current.changes)
+        latest.update(changes)
+        published = Databases(coins, ranking, exchanges,
+                              current.version + 1, latest)
+        databases = published
+    metrics.registry.set_gauge('database_version', published.version)
+    for name, counts in changes.items():
+        tracing.log(logger, logging.INFO, 'database published', name=name,
+                    version=published.version, **counts)
+    return changes
+
+# Returns the positions of the set bits of bitset, lowest first
+def getBits(bitset):
+    bits = []
+    while bitset:
+        low = bitset & -bitset
+        bits.append(low.bit_length() - 1)
+        bitset = bitset ^ low
+    return bits
+
+# Class to represent which coins are listed on which exchanges. Every coin and
+# exchange gets a bit number the first time it is seen and keeps it. Each
+# exchange maps to the bitset of its coins and each coin to the bitset of its
+# exchanges, both stored as ints, so comparing two exchanges is a couple of
+# bitwise operations.
+class ListingIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.coins = []
+        self.coin_bits = dict()
+        self.exchanges = []
+        self.exchange_bits = dict()
+        self.exchange_coins = dict()
+        self.coin_exchanges = dict()
+
+    def get_bit(self, name, names, bits):
+        try:
+            return bits[name]
+        except KeyError:
+            bits[name] = len(names)
+            names.append(name)
+            return bits[name]
+
+    # Applies listings, a dict of exchange name -> coin names, to the index.
+    # Only exchanges whose coins changed are touched, exchanges missing from
+    # listings are removed. Returns the number of added, changed, removed and
+    # unchanged exchanges.
+    def update(self, listings):
+        stats = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+        with self.lock:
+            for exchange in list(self.exchange_coins):
+                if exchange not in listings:
+                    self.set_coins(exchange, 0)
+                    del self.exchange_coins[exchange]
+                    stats['removed'] = stats['removed'] + 1
+
+            for exchange, coins in listings.items():
+                coin_set = 0
+                for coin in coins:
+                    coin_set = coin_set | (1 << self.get_bit(coin,
+                                                             self.coins,
+                                                             self.coin_bits))
+                old = self.exchange_coins.get(exchange)
+                if old == coin_set:
+                    stats['unchanged'] = stats['unchanged'] + 1
+                    continue
+                key = 'added' if old is None else 'changed'
+                stats[key] = stats[key] + 1
+                self.set_coins(exchange, coin_set)
+        return stats
+
+    # Sets the coins of exchange and updates the exchanges of the coins that
+    # were added or removed
+    def set_coins(self, exchange, coin_set):
+        exchange_bit = 1 << self.get_bit(exchange, self.exchanges,
+                                         self.exchange_bits)
+        old = self.exchange_coins.get(exchange, 0)
+        for bit in getBits(old & ~coin_set):
+            coin = self.coins[bit]
+            self.coin_exchanges[coin] = \
+                self.coin_exchanges[coin] & ~exchange_bit
+        for bit in getBits(coin_set & ~old):
+            coin = self.coins[bit]
+            self.coin_exchanges[coin] = \
+                self.coin_exchanges.get(coin, 0) | exchange_bit
+        self.exchange_coins[exchange] = coin_set
+
+    def get_coins(self, exchange):
+        return [self.coins[bit]
+                for bit in getBits(self.exchange_coins.get(exchange, 0))]
+
+    # Returns the coins listed on both exchanges, only on the first and only on
+    # the second, None if either exchange is not in the index
+    def diff(self, first, second):
+        with self.lock:
+            first_set = self.exchange_coins.get(first)
+            second_set = self.exchange_coins.get(second)
+            if first_set is None or second_set is None:
+                return None
+            return tuple([self.coins[bit] for bit in getBits(bitset)]
+                         for bitset in (first_set & second_set,
+                                        first_set & ~second_set,
+                                        second_set & ~first_set))
+
+    # Returns the listings in the form taken by update
+    def get_listings(self):
+        with self.lock:
+            return dict((exchange, self.get_coins(exchange))
+                        for exchange in self.exchange_coins)
+
+    def __len__(self):
+        return len(self.exchange_coins)
+
+# Initialize an index of the coins listed on every exchange. Updated with
+# exchange_database.
+listing_index = ListingIndex()
+
+# Class to coalesce concurrent updates for the same key. The first caller runs
+# the update while every other caller for that key waits for its result.
+class SingleFlight:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = dict()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fn, *args):
+        with self.lock:
+            self.calls = self.calls + 1
+            try:
+                call = self.in_flight[key]
+            except KeyError:
+                call = {'done': threading.Event(), 'result': None,
+                        'error': None}
+                self.in_flight[key] = call
+                leader = True
+            else:
+                self.coalesced = self.coalesced + 1
+                leader = False
 
-# Scrapes CMC's website to retrieve all the exchanges that are listed.
-def updateExchangeDB(exchange_database):
+        # Wait for the caller that is already fetching this key
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
 
-    # Might want to include error handling just in case
-    print("Updating exchange_database...")
-    page = requests.get("https://coinmarketcap.com/exchanges/volume/24-hour/" + 
-                        "all/")
-    soup = BeautifulSoup(page.content, 'html.parser')
+        try:
+            call['result'] = fn(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call['done'].set()
+        return call['result']
+
+    def get_stats(self):
+        with self.lock:
+            return {'calls': self.calls,
+                    'coalesced': self.coalesced,
+                    'in_flight': len(self.in_flight)}
+
+# Coalesces updateCoin / updateExchange calls for the same coin or exchange
+update_flight = SingleFlight()
+
+# Time of the last completed update of the databases and the minimum seconds
+# between updates asked for with /updateDB
+last_db_update = 0.0
+UPDATE_DB_MIN_INTERVAL = 600
+
+# Workers used to refresh stale cache entries in the background
+REFRESH_WORKERS = 2
+refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+refresh_lock = threading.Lock()
+refreshing = set()
+
+# Schedules a background update for key unless one is already pending
+def refreshInBackground(key, fn, *args):
+    with refresh_lock:
+        if key in refreshing:
+            return False
+        refreshing.add(key)
+
+    # Keep the id of the command that scheduled the refresh in its logs
+    request_id = tracing.getRequestId()
+
+    def refresh():
+        with tracing.requestContext(request_id), \
+             httpclient.lane('background'):
+            try:
+                update_flight.do(key, fn, *args)
+            except Exception as e:
+                tracing.log(logger, logging.WARNING,
+                            'background refresh failed', key=key, error=e)
+            finally:
+                with refresh_lock:
+                    refreshing.discard(key)
+
+    refresh_pool.submit(refresh)
+    return True
+
+# Seconds between automatic updates of the databases
+DB_UPDATE_INTERVAL = int(os.environ.get('EXCHANGEBOT_DB_INTERVAL', '21600'))
+
+# The all coins page is only downloaded again if CMC says it changed since the
+# last download (ETag / Last-Modified), and only parsed again if its content
+# hash changed. Every COIN_DB_FULL_EVERY updates the page is downloaded and
+# parsed regardless, 0 never forces a full update.
+COIN_DB_FULL_EVERY = int(os.environ.get('EXCHANGEBOT_COIN_DB_FULL_EVERY', '4'))
+
+# Validators and content hash of the last download of the all coins page
+coin_db_source = {'etag': None, 'last_modified': None, 'hash': None,
+                  'updates': 0}
+
+NO_CHANGES = {'added': 0, 'removed': 0, 'changed': 0}
+
+# Parses the all coins page into a new coin_database and the ranking of its
+# tickers
+def parseCoinDB(html):
+    coins = extractor.extractCoins(html)
+
+    # Populating coin_database and the ranking of its tickers. The first
+    # coin listed with a ticker keeps it.
+    database = dict()
+    ranking = []
+    for ticker, suffix in coins:
+        if ticker not in database:
+            database[ticker] = suffix
+            ranking.append(ticker)
+    return database, ranking
 
-    # Get table
-    table = list(soup.find('table',
-                           class_='table table-condensed border-top').children)
+# Scrapes CMC's website to retrieve the URL path of coin based on the ticker
+# provided and replaces coin_database with them if anything changed. Only the
+# cached markets of the tickers that were removed or moved to another coin are
+# dropped. force skips the conditional request and the hash check. Returns the
+# number of tickers added, removed and changed.
+def updateCoinDB(force=False):
+    full = force or (COIN_DB_FULL_EVERY > 0 and
+                     coin_db_source['updates'] % COIN_DB_FULL_EVERY == 0)
+    headers = dict()
+    if not full:
+        if coin_db_source['etag']:
+            headers['If-None-Match'] = coin_db_source['etag']
+        if coin_db_source['last_modified']:
+            headers['If-Modified-Since'] = coin_db_source['last_modified']
 
-    # Clear exchange_database
-    exchange_database.clear()
+    # Might want to include error handling just in case
+    tracing.log(logger, logging.INFO, 'updating coin_database',
+                conditional=bool(headers))
+    with metrics.Timer('scrape_seconds',
+                       scraper='updateCoinDB',
+                       phase='fetch'):
+        page = httpclient.get(CMC_URL + "/all/views/all/", headers=headers)
+    coin_db_source['updates'] = coin_db_source['updates'] + 1
+    metrics.registry.increment('coin_db_bytes_total', len(page.content))
+
+    if page.status_code == 304:
+        tracing.log(logger, logging.INFO, 'coin_database unchanged',
+                    reason='not modified', bytes=len(page.content))
+        return dict(NO_CHANGES)
+    if page.status_code != 200:
+        tracing.log(logger, logging.WARNING, 'error updating coin_database',
+                    status=page.status_code)
+        return dict(NO_CHANGES)
+
+    coin_db_source['etag'] = page.headers.get('ETag')
+    coin_db_source['last_modified'] = page.headers.get('Last-Modified')
+    digest = hashlib.sha1(page.content).hexdigest()
+    if not full and digest == coin_db_source['hash']:
+        tracing.log(logger, logging.INFO, 'coin_database unchanged',
+                    reason='same hash', bytes=len(page.content))
+        return dict(NO_CHANGES)
+
+    with metrics.Timer('scrape_seconds',
+                       scraper='updateCoinDB',
+                       phase='parse'):
+        database, ranking = parseCoinDB(page.content)
+    if not database:
+        tracing.log(logger, logging.WARNING, 'error updating coin_database',
+                    reason='no coins', bytes=len(page.content))
+        return dict(NO_CHANGES)
+    coin_db_source['hash'] = digest
+
+    # Diff the rows against the database being served, an unchanged database
+    # keeps its version so that nothing keyed on it is invalidated
+    current = databases
+    touched = [ticker for ticker, path in current.coins.items()
+               if database.get(ticker) != path]
+    if not touched and len(database) == len(current.coins) and \
+       tuple(ranking) == current.ranking:
+        tracing.log(logger, logging.INFO, 'coin_database unchanged',
+                    reason='same rows', bytes=len(page.content),
+                    coins=len(database))
+        return dict(NO_CHANGES)
+
+    changes = publishDatabases(coins=database, ranking=ranking)['coins']
+    for ticker in touched:
+        try:
+            del coin_to_exchanges[ticker]
+        except KeyError:
+            pass
+    tracing.log(logger, logging.INFO, 'coin_database updated',
+                bytes=len(page.content), coins=len(database), **changes)
+    return changes
+
+# Scrapes CMC's website to retrieve all the exchanges that are listed and
+# replaces exchange_database with them. Returns the number of exchanges added,
+# removed and changed.
+def updateExchangeDB():
+
+    # Keep the databases being served if the page could not be read
+    tracing.log(logger, logging.INFO, 'updating exchange_database')
+    snapshot = updateExchangeSnapshot()
+    if snapshot is None:
+        tracing.log(logger, logging.WARNING, 'exchange_database not updated')
+        return dict(NO_CHANGES)
+
+    # Build the new exchange_database next to the one being served
+    slugs = dict((name, entry['path'])
+                 for name, entry in snapshot.index.items())
+    changes = publishDatabases(
+        exchanges=ExchangeIndex(snapshot.names, slugs))['exchanges']
+    tracing.log(logger, logging.INFO, 'exchange_database updated',
+                exchanges=len(slugs), **changes)
+
+    # Apply the exchanges whose listings changed to listing_index
+    stats = listing_index.update(dict((name, entry['coins'].names)
+                                      for name, entry
+                                      in snapshot.index.items()))
+    tracing.log(logger, logging.INFO, 'listing_index updated', **stats)
+    return changes
+
+# Class to represent one parse of the all exchanges volume page. index has the
+# structure {exchange_name: {rank, title, path, start_index, end_index, coins}}
+# where coins is the MarketTable of trading pairs that updateExchange caches
+# and start_index / end_index are the range of its trading pair rows.
+class ExchangeSnapshot:
+
+    def __init__(self, rows, time_of_update):
+        self.time_of_update = time_of_update
+        self.names = []
+        self.index = dict()
+
+        # Coin name -> the path of the coin's page on CMC e.g.
+        # /currencies/bitcoin/, used to tell the tickers of the coins apart
+        self.coin_paths = dict()
+
+        # Get the index of every exchange row i.e. a row with an id
+        starts = [i for i in range(len(rows)) if rows[i].id != None]
+
+        # Each exchange ends where the next one starts, the last exchange ends
+        # at the end of the table
+        for j in range(len(starts)):
+            start_index = starts[j]
+            if j + 1 < len(starts):
+                end_index = starts[j + 1]
+            else:
+                end_index = len(rows)
+
+            text = rows[start_index].text.lower()
+            name_and_rank = getNameAndRank(text)
+            if not name_and_rank:
+                continue
+            ex_name, ex_rank = name_and_rank
+            self.names.append(ex_name)
+
+            # Pick the first exchange with that name
+            if ex_name in self.index:
+                continue
+
+            # Removing total section
+            if rows[end_index - 1].text[:5] == 'Total':
+                end_index = end_index - 1
+
+            # Removing view more section
+            if rows[end_index - 1].text == '\nView More\n':
+                end_index = end_index - 1
+
+            # Skip the exchange row and the header row
+            for i in range(start_index + 2, end_index):
+                cell = rows[i].cells[1]
+                if cell.text not in self.coin_paths:
+                    self.coin_paths[cell.text] = cell.href
+
+            # The title keeps the case of the exchange name e.g. Binance
+            self.index[ex_name] = {
+                'rank': ex_rank,
+                'title': rows[start_index].text.strip().split('.', 1)[-1]
+                                                       .strip(),
+                'path': rows[start_index].href,
+                'start_index': start_index + 2,
+                'end_index': end_index,
+                'coins': parseExchangeRows(rows, start_index + 2, end_index)
+            }
+
+    def get(self, exchange):
+        return self.index.get(exchange)
+
+    def age(self):
+        return time.time() - self.time_of_update
+
+# Latest parse of the all exchanges volume page, shared by updateExchange and
+# updateExchangeDB. Reused for EXCHANGE_SNAPSHOT_TTL seconds.
+exchange_snapshot = None
+EXCHANGE_SNAPSHOT_TTL = 60
+
+# Downloads and parses the all exchanges volume page into a new snapshot.
+# Returns None and keeps the previous snapshot if the page could not be read
+# or lists no exchanges.
+def updateExchangeSnapshot():
+    global exchange_snapshot
+    tracing.log(logger, logging.INFO, 'updating exchange snapshot')
+    with metrics.Timer('scrape_seconds', scraper='updateExchangeSnapshot',
+                       phase='fetch'):
+        page = httpclient.get(CMC_URL + "/exchanges/volume/24-hour/all/")
+    if page.status_code != 200:
+        tracing.log(logger, logging.WARNING, 'exchange snapshot not updated',
+                    status=page.status_code)
+        return None
+    with metrics.Timer('scrape_seconds', scraper='updateExchangeSnapshot',
+                       phase='parse'):
+        rows = extractor.extractExchangeVolumes(page.content)
+        snapshot = ExchangeSnapshot(rows, time.time())
+    if not snapshot.index:
+        tracing.log(logger, logging.WARNING, 'exchange snapshot not updated',
+                    reason='no exchanges', bytes=len(page.content))
+        return None
+    exchange_snapshot = snapshot
+    tracing.log(logger, logging.INFO, 'exchange snapshot updated')
+    return snapshot
+
+# Returns the current exchange snapshot, refreshing it if it has expired.
+# Concurrent refreshes are coalesced into a single download. If the refresh
+# fails the previous snapshot is returned, None if there is none.
+def getExchangeSnapshot():
+    snapshot = exchange_snapshot
+    if snapshot is None or snapshot.age() > EXCHANGE_SNAPSHOT_TTL:
+        snapshot = update_flight.do(('snapshot', 'exchanges'),
+                                    updateExchangeSnapshot) or snapshot
+    return snapshot
+
+# Parses the trading pair rows of one exchange in the all exchanges volume
+# table into a MarketTable grouped by coin name
+def parseExchangeRows(rows, start_index, end_index):
+    coins = []
+
+    for i in range(start_index, end_index):
+
+        # Getting coin details
+        rank, name, trading_pair, vol, price, url = \
+            extractor.exchangeVolumeRow(rows[i])
+        vol = int(re.sub("[^\d\.]", "", vol))
+        price = float(re.sub("[^\d\.]", "", price))
+        coins.append((name, trading_pair, vol, price, url, rank))
+    return MarketTable(coins)
+
+# Class to represent the markets of every coin listed in an exchange snapshot.
+# The snapshot lists the trading pairs of every exchange, inverting its rows
+# gives the trading pairs of every coin without downloading the coin's page.
+# The pages of the exchanges on the all exchanges volume page may be cut off
+# after their top pairs, so coins that are not in the crawl, or whose pairs are
+# all on cut off pages, are still updated with updateCoin.
+class MarketCrawl:
+
+    def __init__(self, snapshot, coin_database, version=0):
+        self.time_of_update = snapshot.time_of_update
+        self.db_version = version
+
+        # Ticker -> list of (exchange_name, trading_pair, vol, price, url,
+        # None) rows, the same rows parseMarkets builds from a coin's page
+        self.rows = dict()
+
+        tickers = dict((path, ticker)
+                       for ticker, path in coin_database.items())
+        for entry in snapshot.index.values():
+            coins = entry['coins']
+            for i in range(len(coins.names)):
+                ticker = tickers.get(snapshot.coin_paths.get(coins.names[i]))
+                if ticker is None:
+                    continue
+                try:
+                    rows = self.rows[ticker]
+                except KeyError:
+                    rows = []
+                    self.rows[ticker] = rows
+                for j in range(coins.offsets[i], coins.offsets[i + 1]):
+                    rows.append((entry['title'],
+                                 coins.pairs[coins.pair_ids[j]],
+                                 coins.vols[j],
+                                 coins.prices[j],
+                                 coins.urls[j],
+                                 None))
+
+    # Returns the MarketTable of coin grouped by exchange like parseMarkets,
+    # None if the coin is not in the crawl. Tables are only built when asked
+    # for since most coins are never looked up.
+    def get(self, coin):
+        rows = self.rows.get(coin)
+        if not rows:
+            return None
+        return MarketTable(rows,
+                           sort_by_volume=True,
+                           index_prices=True,
+                           coin=coin)
+
+    def age(self):
+        return time.time() - self.time_of_update
+
+    def __len__(self):
+        return len(self.rows)
+
+# Crawl of the latest exchange snapshot. It is rebuilt the first time it is
+# needed after the snapshot changes and only used while it is younger than
+# CRAWL_MAX_AGE seconds. The crawl job refreshes the snapshot every
+# CRAWL_INTERVAL seconds so it stays fresh.
+market_crawl = None
+CRAWL_MAX_AGE = CACHE_HARD_TTL
+CRAWL_INTERVAL = 300
+
+def buildMarketCrawl(snapshot, dbs):
+    global market_crawl
+    with metrics.Timer('scrape_seconds', scraper='crawlMarkets',
+                       phase='parse'):
+        crawl = MarketCrawl(snapshot, dbs.coins, dbs.version)
+    market_crawl = crawl
+    metrics.registry.set_gauge('crawl_coins', len(crawl))
+    tracing.log(logger, logging.INFO, 'markets crawled', coins=len(crawl),
+                exchanges=len(snapshot.index))
+    return crawl
+
+# Returns the crawl of the current exchange snapshot, None if the snapshot is
+# too old to serve prices from. The crawl is also rebuilt when the coin
+# database changes since it maps the coins to their tickers.
+def getMarketCrawl():
+    snapshot = exchange_snapshot
+    if snapshot is None or snapshot.age() > CRAWL_MAX_AGE:
+        return None
+    dbs = databases
+    crawl = market_crawl
+    if crawl is None or crawl.time_of_update != snapshot.time_of_update or \
+       crawl.db_version != dbs.version:
+        crawl = update_flight.do(('crawl', snapshot.time_of_update,
+                                  dbs.version),
+                                 buildMarketCrawl,
+                                 snapshot,
+                                 dbs)
+    return crawl
+
+# Fills a cold miss of coin from the crawl if it lists the coin, otherwise
+# falls back to downloading the coin's page with updateCoin. The crawl only has
+# the top pairs of most exchanges, so its entry is marked partial and the
+# next lookup refreshes it from the coin's page. An entry that is already in
+# the cache is never replaced with crawl data, and crawl data is never
+# recorded to the history since its volume and prices only cover a few pairs.
+def fillCoin(coin, coin_to_exchanges):
+    try:
+        coin_to_exchanges.peek(coin)
+    except KeyError:
+        pass
+    else:
+        return
+
+    crawl = getMarketCrawl()
+    if crawl is not None:
+        with tracing.span('crawl', coin=coin):
+            exchanges = crawl.get(coin)
+        if exchanges is not None:
+            metrics.registry.increment('crawl_requests_total', result='hit')
+            coin_to_exchanges[coin] = (exchanges, crawl.time_of_update, True)
+            tracing.log(logger, logging.DEBUG, 'coin served from crawl',
+                        coin=coin, markets=len(exchanges.vols))
+            return
+    metrics.registry.increment('crawl_requests_total', result='miss')
+    return updateCoin(coin, coin_to_exchanges)
+
+# Location and format version of the on-disk snapshot of the databases and
+# caches. Bump SNAPSHOT_VERSION whenever the structure of any of them changes so
+# that old snapshots are ignored instead of loaded.
+SNAPSHOT_FILE = 'snapshot.bin'
+SNAPSHOT_MAGIC = b'EXBOT'
+SNAPSHOT_VERSION = 9
+
+# Saves coin_database and the validators of its page, exchange_database,
+# listing_index, coin_to_exchanges and exchange_to_coin to the snapshot file.
+# The snapshot is written to a temporary file first and then renamed over the
+# old one so a crash never leaves a partially written snapshot behind.
+def saveSnapshot(path=SNAPSHOT_FILE):
+    dbs = databases
+    data = {'time_of_update': time.time(),
+            'coin_database': dict(dbs.coins),
+            'coin_ranking': list(dbs.ranking),
+            'coin_db_source': dict(coin_db_source),
+            'exchange_database': (list(dbs.exchanges.names),
+                                  dict(dbs.exchanges.slugs)),
+            'listing_index': listing_index.get_listings(),
+            'coin_to_exchanges': dict(coin_to_exchanges.items()),
+            'exchange_to_coin': dict(exchange_to_coin.items())}
+    payload = zlib.compress(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack('>H', SNAPSHOT_VERSION))
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    tracing.log(logger, logging.INFO, 'snapshot saved', path=path)
+
+# Loads the snapshot file into the module level databases and caches. Returns
+# False if there is no usable snapshot.
+def loadSnapshot(path=SNAPSHOT_FILE):
+    try:
+        with open(path, 'rb') as f:
+            raw = f.read()
+    except IOError:
+        tracing.log(logger, logging.INFO, 'no snapshot found', path=path)
+        return False
 
-    # Get updated exchanges
-    i = 0
+    header_length = len(SNAPSHOT_MAGIC) + 2
+    if raw[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        tracing.log(logger, logging.WARNING, 'invalid snapshot file',
+                    path=path)
+        return False
 
-    while(i < len(table)):
+    version = struct.unpack('>H', raw[len(SNAPSHOT_MAGIC):header_length])[0]
+    if version != SNAPSHOT_VERSION:
+        tracing.log(logger, logging.WARNING, 'ignoring snapshot',
+                    version=version)
+        return False
 
-        # Only look at rows with a 'tr' tag and an id that is not None
-        if table[i].name == 'tr' and table[i].get('id') != None:
-            name, rank = getNameAndRank(table[i].get_text().lower())
+    try:
+        data = pickle.loads(zlib.decompress(raw[header_length:]))
+    except Exception as e:
+        tracing.log(logger, logging.ERROR, 'error loading snapshot', error=e)
+        return False
 
-            # Append to list of exchanges
-            exchange_database.append(name)
-        i = i + 1
-    print("Update complete!")
+    publishDatabases(coins=data['coin_database'],
+                     ranking=data['coin_ranking'],
+                     exchanges=ExchangeIndex(*data['exchange_database']))
+    coin_db_source.update(data['coin_db_source'])
+    listing_index.update(data['listing_index'])
+    coin_to_exchanges.update(data['coin_to_exchanges'])
+    exchange_to_coin.update(data['exchange_to_coin'])
+    tracing.log(logger, logging.INFO, 'snapshot loaded', path=path)
+    return True
 
 # Check if coin ticker exists in coin_to_exchanges dictionary
 def checkCoin(coin, coin_to_exchanges):
@@ -94,10 +985,10 @@ def checkCoin(coin, coin_to_exchanges):
     try:
         coin_to_exchanges[coin]
     except KeyError:
-        print(coin + " not found!")
+        tracing.log(logger, logging.DEBUG, 'coin not cached', coin=coin)
         return False
     else:
-        print(coin + " found!")
+        tracing.log(logger, logging.DEBUG, 'coin cached', coin=coin)
         return True
 
 # Check if exchange name exists in exchange_to_coin database
@@ -106,20 +997,21 @@ def checkExchange(exchange, exchange_to_coin):
     try:
         exchange_to_coin[exchange]
     except KeyError:
-        print(exchange + " not found!")
+        tracing.log(logger, logging.DEBUG, 'exchange not cached',
+                    exchange=exchange)
         return False
     else:
-        print(exchange + " found!")
+        tracing.log(logger, logging.DEBUG, 'exchange cached',
+                    exchange=exchange)
         return True
 
-# Get html source code for the given coin ticker
-def getSource(type, *args):
-    print("In getSource function")
+# Get the URL of the CMC page for the given type
+def getUrl(type, *args):
 
     if type == 'coin':
 
         # URL for getting coin details
-        url = 'https://coinmarketcap.com' + coin_database[args[0]]
+        return CMC_URL + databases.coins[args[0]]
     elif type == 'history':
 
         # Getting the date today and delta
@@ -127,228 +1019,348 @@ def getSource(type, *args):
         delta = datetime.timedelta(days=int(args[1]))
 
         # URL for getting historical data
-        url = 'https://coinmarketcap.com' + coin_database[args[0]] +\
+        return CMC_URL + databases.coins[args[0]] +\
         'historical-data/?start=' + (today - delta).strftime('%Y%m%d') +\
         '&end=' + today.strftime('%Y%m%d')
     elif type == 'exchange':
 
         # URL for getting the exchange details
-        url = "http://coinmarketcap.com" + args[0]
-    else:
+        return CMC_URL + args[0]
+    return False
+
+# Get raw html for the given type, False if the page cannot be found
+def getHtml(type, *args):
+    url = getUrl(type, *args)
+    if not url:
         return False
-    page = requests.get(url)
+    page = httpclient.get(url)
 
     if page.status_code == 404:
-        print("Source code not found")
+        tracing.log(logger, logging.WARNING, 'page not found', url=url)
         return False
     else:
-        print("Source code found!")
-        return BeautifulSoup(page.content, 'html.parser')
+        return page.content
+
+# Get html source code for the given coin ticker
+def getSource(type, *args):
+    html = getHtml(type, *args)
+    if not html:
+        return False
+    return BeautifulSoup(html, 'html.parser')
+
+# Parse the markets table of a coin into a MarketTable grouped by exchange
+# name, sorted by total vol descending.
+def parseMarkets(html, coin):
+    rows = []
+
+    for row in extractor.extractMarkets(html):
+        exchange_name, trading_pair, vol, price, url = row
+
+        # Remove $ and commas for volume and convert to int
+        vol = int(re.sub("[^\d\.]", "", vol))
+
+        # Remove $ and commas for price and convert to float
+        price = float(re.sub("[^\d\.]", "", price))
+
+        rows.append((exchange_name, trading_pair, vol, price, url, None))
+    return MarketTable(rows,
+                       sort_by_volume=True,
+                       index_prices=True,
+                       coin=coin)
+
+# Keeps a snapshot of the markets of coin for the accumulation tracker. Only
+# full coin pages are recorded, partial tables would skew the 24h volume and
+# prices of the history.
+def recordHistory(coin, exchanges, time_of_update):
+    try:
+        history.store.record(coin, exchanges, time_of_update)
+    except (IOError, OSError) as e:
+        tracing.log(logger, logging.ERROR, 'error recording history',
+                    coin=coin, error=e)
 
 # Updates exchanges and volume for the specified coin
 def updateCoin(coin, coin_to_exchanges):
-    print("In updateCoin function")
-
     # Get source code
-    soup = getSource('coin', coin)
+    with tracing.span('fetch', coin=coin), \
+         metrics.Timer('scrape_seconds', scraper='updateCoin', phase='fetch'):
+        html = getHtml('coin', coin)
 
     # Process source code to get unique list of exchanges for coin
-    if soup:
-        table = list(soup.find('table', id='markets-table').children)
-        tbody = list(table[3].children)
-        i = 1
-
-        # Parse the entire tbody into a namedtuple array, sorted by total vol
-        # descending.
-        exchanges = dict()
-
-        while(i < len(tbody)):
-            data = list(tbody[i].children)
-
-            # Get name of exchange
-            exchange_name = list(data[3].children)[3].get_text()
-
-            # Get trading pair
-            trading_pair = list(data[5].children)[0].get_text()
-            
-            # Remove $ and commas for volume and convert to int
-            vol = int(re.sub("[^\d\.]",
-                             "",
-                             list(data[7].children)[1].get_text()))
-
-            # Remove $ and commas for price and convert to float
-            price = float(re.sub("[^\d\.]",
-                                 "",
-                                 list(data[9].children)[1].get_text()))
-
-            # Get trading pair url
-            url = list(data[5].children)[0]['href']
-
-            try: 
-                exchanges[exchange_name]
-            except KeyError:
-                exchanges[exchange_name] = Coin(trading_pair,
-                                                vol,
-                                                price,
-                                                url)
-            else:
-                exchanges[exchange_name].add_new_entry(vol)
-                exchanges[exchange_name].add_details('trading_pair',
-                                                     trading_pair)
-                exchanges[exchange_name].add_details('vol', vol)
-                exchanges[exchange_name].add_details('price', price)
-                exchanges[exchange_name].add_details('url', url)
-            i = i + 2
-
-        # Sort exchange based on total volume
-        exchanges = sorted(exchanges.items(),
-                           key=lambda detail: detail[1].total_vol,
-                           reverse=True)
+    if html:
+        with tracing.span('parse', coin=coin), \
+             metrics.Timer('scrape_seconds',
+                           scraper='updateCoin',
+                           phase='parse'):
+            exchanges = parseMarkets(html, coin)
 
         # Returns all exchanges, filtering top 10 exchanges logic is separated
         # outside. For /c, you just slice off first 10. For /min or /max, you
         # need to filter by ticker first then slice off top 10. 
-        coin_to_exchanges[coin] = (exchanges, time.time())
-        print(coin + " updated!")
+        time_of_update = time.time()
+        coin_to_exchanges[coin] = (exchanges, time_of_update, False)
+        tracing.log(logger, logging.INFO, 'coin updated', coin=coin,
+                    markets=len(exchanges.vols))
+        recordHistory(coin, exchanges, time_of_update)
     else:
-        print("Error updating " + coin + "!")
+        tracing.log(logger, logging.WARNING, 'error updating coin', coin=coin)
         return False
 
 # Scrapes CMC's website to retrieve the trading pairs with the highest rolling 
 # 24 hour trade volume based on the exchange name provided
 def updateExchange(exchange, exchange_to_coin):
-    print("In updateExchange function")
-    page = requests.get("https://coinmarketcap.com/exchanges/volume/24-hour/" + 
-                        "all/")
-    soup = BeautifulSoup(page.content, 'html.parser')
-
-    # Process source code to get top traded pairs for exchange
-    if soup:
-        table = soup.find('table', class_='table table-condensed border-top')
-        table = list(table.children)
-
-        # Variables used to help navigate table
-        i = 0
-        found = False
-        start_index = 0
-        end_index = 0
-
-        while(i < len(table)):
+    # Look the exchange up in the parsed all exchanges volume page
+    snapshot = getExchangeSnapshot()
+    entry = snapshot.get(exchange) if snapshot is not None else None
 
-            # Only look at rows with a 'tr' tag and an id that is not None
-            if table[i].name == 'tr' and table[i].get('id') != None:
-
-                # Break after you retrieve the end index
-                if(found):
-                    end_index = i
-                    break;
-
-                ex_name, ex_rank = getNameAndRank(table[i].get_text().lower())
-
-                # Find the index of the exchange
-                if(exchange == ex_name and not found):
-                    start_index = i
-                    found = True
-            i = i + 1
-
-        # Removing total section
-        if table[end_index - 2].get_text()[:5] == 'Total':
-            end_index = end_index - 2
-
-        # Removing view more section
-        if table[end_index - 2].get_text() == '\nView More\n':
-            end_index = end_index - 2
+    if entry:
 
         # Getting the URL and volume of the exchange
-        path = table[start_index].find('a')['href']
-        soup = getSource('exchange', path)
+        with tracing.span('fetch', exchange=exchange), \
+             metrics.Timer('scrape_seconds', scraper='updateExchange',
+                           phase='fetch'):
+            soup = getSource('exchange', entry['path'])
+        if not soup:
+            tracing.log(logger, logging.WARNING, 'error updating exchange',
+                        exchange=exchange)
+            return False
         ex_url = list(soup.find('ul', class_='list-unstyled').children)
         ex_url = ex_url[1].find('a')['href']
         ex_vol = soup.find('div', class_="col-sm-8 bottom-margin-1x")
         ex_vol = ex_vol.find(class_="h2").get_text()
 
-        # Getting the trading pairs of the exchange
-        coins = dict()
-        i = start_index + 4
-
-        while(i < end_index):
-
-            # Getting coin details
-            entry = list(table[i].children)
-            rank = entry[1].get_text()
-            name = entry[3].get_text()
-            trading_pair = entry[5].get_text()
-            url = entry[5].find('a')['href']
-            vol = int(re.sub("[^\d\.]", "", entry[7].get_text()))
-            price = float(re.sub("[^\d\.]", "", entry[9].get_text()))
-
-            # Updating coins dict
-            try: 
-                coins[name]
-            except KeyError:
-                coins[name] = Coin(trading_pair, vol, price, url)
-                coins[name].add_details('rank', rank)
-            else:
-                coins[name].add_new_entry(vol)
-                coins[name].add_details('trading_pair', trading_pair)
-                coins[name].add_details('vol', vol)
-                coins[name].add_details('price', price)
-                coins[name].add_details('url', url)
-                coins[name].add_details('rank', rank)
-            i = i + 2
-        coins = coins.items()
-        exchange_to_coin[exchange] = (ex_rank,
+        exchange_to_coin[exchange] = (entry['rank'],
                                       ex_vol,
                                       ex_url,
-                                      coins,
+                                      entry['coins'],
                                       time.time())
-        print(exchange + " updated!")
+        tracing.log(logger, logging.INFO, 'exchange updated',
+                    exchange=exchange)
     else:
-        print("Error updating " + coin + "!")
+        tracing.log(logger, logging.WARNING, 'exchange not listed',
+                    exchange=exchange)
         return False
 
-# Class to represent the trading pair, volume, price and url details
-class Coin:
-
-    def add_new_entry(self, vol):
-        self.total_vol = self.total_vol + vol
-        self.details.append(dict())
-
-    def add_details(self, key, value):
-        self.details[-1][key] = value
-
-    def __init__(self, trading_pair, vol, price, url):
-        self.total_vol = 0
-        self.details = []
-        self.add_new_entry(vol)
-        self.add_details('trading_pair', trading_pair)
-        self.add_details('vol', vol)
-        self.add_details('price', price)
-        self.add_details('url', url)
+# Quote assets that a filter ending in * also matches e.g. /min BTC USD* shows
+# the cheapest BTC pairs quoted in USD or a USD stablecoin
+QUOTE_FAMILIES = {
+    'USD': ('USD', 'USDT', 'TUSD', 'USDC', 'PAX', 'GUSD', 'DAI', 'BUSD'),
+    'EUR': ('EUR', 'EURS', 'EURT')
+}
+
+# Splits a trading pair e.g. BTC/USDT into its base and quote assets
+def splitPair(trading_pair):
+    base, sep, quote = trading_pair.partition('/')
+    return base.strip().upper(), quote.strip().upper()
+
+# Returns the asset a coin's trading pair is quoted against. This is normally
+# the quote asset, but for coins that are themselves the quote asset e.g.
+# BTC/USDT on the USDT markets page, it is the base asset.
+def getCounterAsset(trading_pair, coin=None):
+    base, quote = splitPair(trading_pair)
+    if coin is not None and quote == coin and base != coin:
+        return base
+    return quote
+
+# Class to represent the trading pairs of a coin grouped by exchange, or of an
+# exchange grouped by coin. Rows are stored in columns so a cached coin costs a
+# few bytes per trading pair. Group and trading pair names are interned and
+# stored once, the rows of group i are rows offsets[i] to offsets[i + 1] - 1.
+class MarketTable:
+    __slots__ = ('names', 'totals', 'offsets', 'pairs', 'pair_ids', 'vols',
+                 'prices', 'urls', 'ranks', 'cheapest', 'most_expensive',
+                 'quotes')
+
+    # rows is a list of (group_name, trading_pair, vol, price, url, rank)
+    # tuples, rank is None when it is not known. Groups keep the order in which
+    # they first appear unless sort_by_volume is set. index_prices builds the
+    # price ordered and quote asset indexes used by top_by_price, coin is the
+    # ticker whose trading pairs are in the table.
+    def __init__(self, rows, sort_by_volume=False, index_prices=False,
+                 coin=None):
+        groups = OrderedDict()
+        for row in rows:
+            try:
+                groups[row[0]].append(row)
+            except KeyError:
+                groups[row[0]] = [row]
+
+        totals = dict((name, sum(row[2] for row in group))
+                      for name, group in groups.items())
+        order = list(groups.keys())
+        if sort_by_volume:
+            order = sorted(order, key=lambda name: totals[name], reverse=True)
+
+        self.names = [sys.intern(name) for name in order]
+        self.totals = array('q', [totals[name] for name in order])
+        self.offsets = array('I', [0])
+        self.pairs = []
+        self.pair_ids = array('I')
+        self.vols = array('q')
+        self.prices = array('d')
+        self.urls = []
+        self.ranks = None
+
+        pair_index = dict()
+        for name in order:
+            for row in groups[name]:
+                try:
+                    pair_id = pair_index[row[1]]
+                except KeyError:
+                    pair_id = len(self.pairs)
+                    pair_index[row[1]] = pair_id
+                    self.pairs.append(sys.intern(row[1]))
+                self.pair_ids.append(pair_id)
+                self.vols.append(row[2])
+                self.prices.append(row[3])
+                self.urls.append(row[4])
+                if row[5] is not None:
+                    if self.ranks is None:
+                        self.ranks = []
+                    self.ranks.append(row[5])
+            self.offsets.append(len(self.vols))
+
+        # Row numbers ordered by price. Rows with the same price keep their
+        # order in the table in both directions, like a stable sort does.
+        self.cheapest = None
+        self.most_expensive = None
+        self.quotes = None
+        if index_prices:
+            prices = self.prices
+            self.cheapest = array('I', sorted(range(len(prices)),
+                                              key=lambda j: prices[j]))
+            self.most_expensive = array('I', sorted(range(len(prices)),
+                                                    key=lambda j: -prices[j]))
+
+            # Inverted index of quote asset -> (cheapest, most_expensive) row
+            # numbers of the trading pairs quoted in that asset
+            pair_quotes = [sys.intern(getCounterAsset(pair, coin))
+                           for pair in self.pairs]
+            self.quotes = dict()
+            for index_number, index in enumerate((self.cheapest,
+                                                  self.most_expensive)):
+                for j in index:
+                    quote = pair_quotes[self.pair_ids[j]]
+                    try:
+                        entry = self.quotes[quote]
+                    except KeyError:
+                        entry = (array('I'), array('I'))
+                        self.quotes[quote] = entry
+                    entry[index_number].append(j)
+
+    # Number of groups
+    def __len__(self):
+        return len(self.names)
+
+    # Returns row j of group i as a (group_name, trading_pair, vol, price, url)
+    # tuple, with the rank appended if the table has ranks
+    def row(self, i, j):
+        result = (self.names[i],
+                  self.pairs[self.pair_ids[j]],
+                  self.vols[j],
+                  self.prices[j],
+                  self.urls[j])
+        if self.ranks is not None:
+            result = result + (self.ranks[j],)
+        return result
+
+    # Returns every row, group by group
+    def get_rows(self):
+        return [self.row(i, j)
+                for i in range(len(self.names))
+                for j in range(self.offsets[i], self.offsets[i + 1])]
+
+    # Returns the limit cheapest ('min') or most expensive ('max') rows. If
+    # quote is given only trading pairs quoted in it are returned, if family is
+    # also set pairs quoted in any asset of its QUOTE_FAMILIES entry are too.
+    def top_by_price(self, order, limit, quote=None, family=False):
+        if order == 'min':
+            index_number = 0
+            index = self.cheapest
+            key = lambda j: (self.prices[j], j)
+        else:
+            index_number = 1
+            index = self.most_expensive
+            key = lambda j: (-self.prices[j], j)
 
-    def get_details(self):
-        return self.details
+        if quote is None:
+            rows = index[:limit]
+        else:
+            quotes = [quote]
+            if family:
+                quotes = QUOTE_FAMILIES.get(quote, quotes)
+            indexes = [self.quotes[q][index_number] for q in quotes
+                       if q in self.quotes]
+
+            # Merge the price ordered rows of every matching quote asset
+            if len(indexes) == 1:
+                rows = indexes[0][:limit]
+            else:
+                rows = []
+                for j in heapq.merge(*indexes, key=key):
+                    rows.append(j)
+                    if len(rows) == limit:
+                        break
+
+        return [self.row(bisect.bisect_right(self.offsets, j) - 1, j)
+                for j in rows]
+
+    # Returns (group_name, total_vol, url of the first trading pair) for the
+    # first limit groups
+    def top(self, limit):
+        return [(self.names[i], self.totals[i], self.urls[self.offsets[i]])
+                for i in range(min(limit, len(self.names)))]
+
+# Counts and logs a lookup of key in cache by its outcome: 'hit', 'stale'
+# (served and refreshed in the background), 'expired' (refreshed before
+# serving) or 'miss'
+def countCacheRequest(cache, key, result):
+    metrics.registry.increment('cache_requests_total', cache=cache,
+                               result=result)
+    tracing.log(logger, logging.DEBUG, 'cache lookup', cache=cache, key=key,
+                result=result)
 
 # Function to get trading pairs with the highest rolling 24 hr volume
 # for the given exchange
 def getCoinsWithCache(exchange, exchange_to_coin):
 
-    # Checks if exchange is in the exchange_to_coin cache
+    # Checks if exchange is in the exchange_to_coin cache. The entry is read
+    # once since another command may evict it at any time.
+    entry = None
     if checkExchange(exchange, exchange_to_coin):
-        print("Exchange found in cache")
-
-        # Checks if more than a minute has passed, if so update exchange cache
-        if time.time() - exchange_to_coin[exchange][4] > 60:
-            print("updating cache for " + exchange)
-            updateExchange(exchange, exchange_to_coin)
+        try:
+            entry = exchange_to_coin.peek(exchange)
+        except KeyError:
+            pass
+
+    if entry is not None:
+
+        # Past the hard threshold wait for the update, past the soft threshold
+        # serve the cached entry and update it in the background
+        age = time.time() - entry[4]
+        if age > CACHE_HARD_TTL:
+            countCacheRequest('exchange_to_coin', exchange, 'expired')
+            update_flight.do(('exchange', exchange),
+                             updateExchange,
+                             exchange,
+                             exchange_to_coin)
+        elif age > CACHE_SOFT_TTL:
+            countCacheRequest('exchange_to_coin', exchange, 'stale')
+            refreshInBackground(('exchange', exchange),
+                                updateExchange,
+                                exchange,
+                                exchange_to_coin)
+        else:
+            countCacheRequest('exchange_to_coin', exchange, 'hit')
     else:
 
         # If cache doesn't contain exchange, add it in
-        print("Exchange not found in cache.")
-        print("Processing trading pair volume data for " + exchange)
-        updateExchange(exchange, exchange_to_coin)
+        countCacheRequest('exchange_to_coin', exchange, 'miss')
+        update_flight.do(('exchange', exchange),
+                         updateExchange,
+                         exchange,
+                         exchange_to_coin)
     try:
-        return exchange_to_coin[exchange][3]
+        return exchange_to_coin.peek(exchange)[3]
     except KeyError:
         return False
 
@@ -356,71 +1368,155 @@ def getCoinsWithCache(exchange, exchange_to_coin):
 # Function to get list of exchanges for the given coin
 def getExchangeWithCache(coin, coin_to_exchanges):
 
-    # Checks if coin is in the coin_to_exchanges cache
+    # Checks if coin is in the coin_to_exchanges cache. The entry is read once
+    # since another command may evict it at any time.
+    entry = None
     if checkCoin(coin, coin_to_exchanges):
-        print("Coin found in cache")
-
-        # Checks if more than a minute has passed, if so update cache for coin
-        if(time.time() - coin_to_exchanges[coin][1] > 60):
-            print("Updating cache for " + coin)
-            updateCoin(coin, coin_to_exchanges)
+        try:
+            entry = coin_to_exchanges.peek(coin)
+        except KeyError:
+            pass
+
+    if entry is not None:
+
+        # Past the hard threshold wait for the update, past the soft threshold
+        # or for a partial entry from the crawl serve the cached entry and
+        # update it from the coin's page in the background
+        age = time.time() - entry[1]
+        if age > CACHE_HARD_TTL:
+            countCacheRequest('coin_to_exchanges', coin, 'expired')
+            update_flight.do(('coin', coin),
+                             updateCoin,
+                             coin,
+                             coin_to_exchanges)
+        elif age > CACHE_SOFT_TTL or entry[2]:
+            countCacheRequest('coin_to_exchanges', coin, 'stale')
+            refreshInBackground(('coin', coin),
+                                updateCoin,
+                                coin,
+                                coin_to_exchanges)
+        else:
+            countCacheRequest('coin_to_exchanges', coin, 'hit')
     else:
-        
-        # If the cache doesn't contain coin, add it in.
-        print("Coin not found in cache.")
-        print("Processing exchange data for " + coin)
-        updateCoin(coin, coin_to_exchanges)
+
+        # If the cache doesn't contain coin, add it in from the crawl of the
+        # exchange snapshot or else from the coin's page
+        countCacheRequest('coin_to_exchanges', coin, 'miss')
+        update_flight.do(('coin', coin),
+                         fillCoin,
+                         coin,
+                         coin_to_exchanges)
 
     try:
-        return coin_to_exchanges[coin][0]
+        return coin_to_exchanges.peek(coin)[0]
     except KeyError:
         return False
 
+# Longest message Telegram accepts and the rows shown per page of /c, /min and
+# /max. Pages of /e are only limited by the message length.
+MESSAGE_LIMIT = 4096
+PAGE_ROWS = 10
+
+# Trading pairs listed by /min and /max over all their pages
+PRICE_RESULTS = 50
+
 # Function to concatenate a list of exchanges into multiple strings max
-# character length of 4096
-def concatExchanges(exchanges):
-    return '\n'.join(exchanges)
-
-# Parse cache to retrieve all the trading pairs for a given exchange
-def parseExchange(exchanges, order, ticker=None):
-
-    # Parse the exchanges argument into something more readable
-    results = []
-    for i in exchanges:
-        for j in i[1].get_details():
-            results.append((i[0],
-                            j['trading_pair'],
-                            j['vol'],
-                            j['price'],
-                            j['url']))
-
-    # Filter results
-    updated_results = []
-    if ticker != None:
-        for i in results:
-            if ticker in i[1]:
-                updated_results.append(i)
-    else:
-        updated_results = results
+# character length of 4096. Every string starts with the header lines and
+# holds at most max_rows exchanges. Pages are only split between rows so that
+# the Markdown of a row is never cut in half. When there is more than one
+# page every string gets a page number.
+def concatExchanges(header, exchanges, max_rows=None):
+    header_size = len('\n'.join(header))
+    footer_size = len('\nPage 999/999')
+    pages = []
+    page = []
+    size = header_size
+    for line in exchanges:
+        if page and ((max_rows and len(page) >= max_rows) or
+                     size + 1 + len(line) > MESSAGE_LIMIT - footer_size):
+            pages.append(page)
+            page = []
+            size = header_size
+        page.append(line)
+        size = size + 1 + len(line)
+    pages.append(page)
+
+    if len(pages) == 1:
+        return ['\n'.join(header + pages[0])]
+    return ['\n'.join(header + page) + '\nPage ' + str(i + 1) + '/' +
+            str(len(pages))
+            for i, page in enumerate(pages)]
+
+# Cache of the rendered pages of /c, /min, /max and /e replies. Entries are
+# keyed by an id of (command, arguments, time of update of the data) so that
+# an entry is never served once the data it was rendered from is updated. The
+# id is short enough to go into the callback data of the page buttons.
+RENDER_MAX_ENTRIES = 2000
+RENDER_MAX_BYTES = 16 * 1024 * 1024
+rendered_cache = BoundedCache(RENDER_MAX_ENTRIES,
+                              RENDER_MAX_BYTES,
+                              CACHE_HARD_TTL)
+
+def getRenderId(key):
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12]
+
+# Returns the id and the pages of key, calling render() for the pages unless
+# they are cached
+def getRenderedPages(key, render):
+    render_id = getRenderId(key)
+    entry = rendered_cache.get(render_id)
+    if entry is not None and entry[0] == key:
+        countCacheRequest('rendered', key[0], 'hit')
+        return render_id, entry[1]
+
+    countCacheRequest('rendered', key[0], 'miss')
+    with tracing.span('render', command=key[0]):
+        pages = render()
+    rendered_cache[render_id] = (key, pages)
+    return render_id, pages
+
+# Returns the previous / next buttons of page number page out of pages, None
+# if there is only one page
+def getPageKeyboard(render_id, page, pages):
+    if pages < 2:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton(
+            '< Prev', callback_data='page:' + render_id + ':' + str(page - 1)))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton(
+            'Next >', callback_data='page:' + render_id + ':' + str(page + 1)))
+    return InlineKeyboardMarkup([buttons])
+
+# Sends the first of pages as a reply to update with buttons for the others
+def sendPages(bot, update, render_id, pages):
+    with tracing.span('send', pages=len(pages)):
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=pages[0],
+                         disable_web_page_preview=True,
+                         parse_mode='Markdown',
+                         reply_markup=getPageKeyboard(render_id, 0,
+                                                      len(pages)),
+                         reply_to_message_id=update.message.message_id)
 
-    if updated_results == []:
+# Parse cache to retrieve the limit cheapest / most expensive trading pairs for
+# a given coin using its price index. ticker filters by quote asset, a ticker
+# ending in * filters by the whole quote family e.g. USD*.
+def parseExchange(exchanges, order, ticker=None, limit=10):
+    family = False
+    if ticker != None and ticker.endswith('*'):
+        ticker = ticker[:-1]
+        family = True
+    results = exchanges.top_by_price(order, limit, ticker, family)
+
+    if results == []:
         return False
-
-    if order == 'min':
-        return sorted(updated_results, key=lambda x: x[3], reverse=False)[:10]
-    return sorted(updated_results, key=lambda x: x[3], reverse=True)[:10]
+    return results
 
 # Parse cache to retrieve all trading pairs for a given coin
 def parseCoin(coins):
-    results = []
-    for i in coins:
-        for j in i[1].get_details():
-            results.append((i[0],
-                            j['trading_pair'],
-                            j['vol'],
-                            j['price'],
-                            j['url'],
-                            j['rank']))
+    results = coins.get_rows()
 
     # Return the top 10 traded pairs
     return sorted(results, key=lambda x: x[2], reverse=True)
@@ -447,139 +1543,343 @@ def getNameAndRank(dirty_text):
 
     return exchange_name, exchange_rank
 
-# Function to analyse if a coin is getting pumped
-# def analyse(*args):
-#     print("In analyse function")
-
-#     # Get source code
-#     soup = getSource('history', args[0], args[1])
-
-#     if not soup:
-#         body = list(soup.select(
-#             'div#historical-data table.table')[0].children)[3]
-#         rows = list(body.children)
-#         i = len(rows) - 2
-#         accumulationFactor = 0
-
-#         while(i - 2 > 0):
+# Longest history in days that /analyse accepts
+ANALYSE_MAX_DAYS = 730
+
+# Returns the name that the markets of exchange were recorded under for coin
+# over the last days, None if none were recorded
+def getRecordedExchange(coin, exchange, days):
+    end = time.time()
+    name = normalizeExchange(exchange)
+    for recorded in history.store.exchanges(coin, end - days * 86400, end):
+        if normalizeExchange(recorded) == name:
+            return recorded
+    return None
+
+# Returns the daily history of coin over the last days from CMC's historical
+# data page, or from the snapshots recorded in the history store if the page
+# cannot be read. The history of one exchange only comes from the store.
+def getHistory(coin, days, exchange=None):
+    if exchange is not None:
+        end = time.time()
+        return accumulation.fromBars(
+            history.store.ohlcv(coin, end - days * 86400, end,
+                                exchange=exchange))
+
+    with tracing.span('fetch', coin=coin), \
+         metrics.Timer('scrape_seconds', scraper='getHistory', phase='fetch'):
+        html = getHtml('history', coin, days)
+
+    if html:
+        with tracing.span('parse', coin=coin), \
+             metrics.Timer('scrape_seconds', scraper='getHistory',
+                           phase='parse'):
+            rows = extractor.extractHistory(html)
+            if rows:
+                return accumulation.fromRows(rows)
+
+    tracing.log(logger, logging.INFO, 'using recorded history', coin=coin)
+    end = time.time()
+    return accumulation.fromBars(
+        history.store.ohlcv(coin, end - days * 86400, end))
 
-#             # 3 = open, 9 = closed, 11 = volume
-#             row_a = list(rows[i])
-#             open_a = int(row_a[3].get_text())
-#             close_a = int(row_a[9].get_text())
-#             vol_a = int(row_a[11].get_text().replace(',', ''))
-
-#             row_b = list(rows[i-2])
-#             open_b = int(row_b[3].get_text())
-#             close_b = int(row_b[9].get_text())
-#             vol_b = int(row_b[11].get_text().replace(',', ''))
-
-#             i = i - 2
+# Function to analyse if a coin is getting pumped
+def analyse(coin, days, exchange=None):
+    daily = getHistory(coin, days, exchange)
+    with tracing.span('analyse', coin=coin, days=len(daily)):
+        return accumulation.analyse(daily)
 
-#         while(i < len(rows)):
+##################################
+#    Metrics and Admin Tools     #
+##################################
 
-#             row = list(rows[i])
-#             vol = int(row[11].get_text().replace(',', ''))
-#             print(vol)
-#             sum += vol
-#             i = i + 2
+# File the metrics are written to in the Prometheus text format, for the
+# node_exporter textfile collector
+METRICS_FILE = 'metrics.prom'
 
-#         print("Sum is " + str(sum))
+# Telegram user ids allowed to run admin commands such as /stats
+admin_ids = set()
 
-#         print(args[1])
-#     else:
-#         print("Analysis failed. Please check that you've entered the correct" +
-#               " parameters.")
+# Loads the admin user ids from path, one id per line
+def loadAdmins(path='admins.txt'):
+    try:
+        with open(path) as f:
+            ids = set(int(line) for line in f if line.strip())
+    except (IOError, ValueError) as e:
+        tracing.log(logger, logging.WARNING, 'no admins loaded', error=e)
+        return False
+    admin_ids.clear()
+    admin_ids.update(ids)
+    return True
+
+def isAdmin(update):
+    return update.message.from_user.id in admin_ids
+
+# Copies the sizes and totals of the caches, databases, limiter and single
+# flight into gauges and counters
+def updateMetricGauges():
+    for name, cache in (('coin_to_exchanges', coin_to_exchanges),
+                        ('exchange_to_coin', exchange_to_coin),
+                        ('rendered', rendered_cache)):
+        stats = cache.get_stats()
+        metrics.registry.set_gauge('cache_entries', stats['entries'],
+                                   cache=name)
+        metrics.registry.set_gauge('cache_bytes', stats['bytes'], cache=name)
+        metrics.registry.set_counter('cache_evictions_total',
+                                     stats['evictions'], cache=name)
+
+    stats = workers.pool.get_stats()
+    metrics.registry.set_gauge('commands_running', stats['running'])
+    metrics.registry.set_gauge('commands_queued', stats['queued'])
+
+    stats = httpclient.client.limiter.get_stats()
+    metrics.registry.set_gauge('limiter_tokens', stats['tokens'])
+    for name, lane in stats['lanes'].items():
+        metrics.registry.set_gauge('limiter_waiting', lane['waiting'],
+                                   lane=name)
+        metrics.registry.set_counter('limiter_granted_total',
+                                     lane['granted'], lane=name)
+        metrics.registry.set_counter('limiter_wait_seconds_total',
+                                     lane['wait_seconds'], lane=name)
+
+    stats = update_flight.get_stats()
+    metrics.registry.set_counter('update_calls_total', stats['calls'])
+    metrics.registry.set_counter('update_coalesced_total',
+                                 stats['coalesced'])
+    metrics.registry.set_gauge('update_in_flight', stats['in_flight'])
+    dbs = databases
+    metrics.registry.set_gauge('database_entries', len(dbs.coins),
+                               database='coin')
+    metrics.registry.set_gauge('database_entries', len(dbs.exchanges),
+                               database='exchange')
+
+# Returns the kind of CMC page of path, with the coin or exchange replaced by
+# a * e.g. /currencies/*/historical-data/
+def getEndpoint(path):
+    return re.sub(r'^/(currencies|exchanges)/(?!volume/)[^/]+/', r'/\1/*/',
+                  path)
+
+# Escapes the characters that Telegram's Markdown would read as formatting
+def escapeMarkdown(text):
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+# Returns the lines of the /stats report
+def formatStats():
+    lines = ['Commands (count, p50, p95):']
+    commands = metrics.registry.get_histograms('command_seconds')
+    for key in sorted(commands):
+        histogram = commands[key]
+        lines.append(' /' + dict(key)['command'] + ': ' +
+                     str(histogram.count) + ', ' +
+                     '{:.3f}s, {:.3f}s'.format(histogram.quantile(0.5),
+                                               histogram.quantile(0.95)))
+
+    lines.append('Caches:')
+    requests = metrics.registry.get_counters('cache_requests_total')
+    for name, cache in (('coin_to_exchanges', coin_to_exchanges),
+                        ('exchange_to_coin', exchange_to_coin),
+                        ('rendered', rendered_cache)):
+        counts = dict((dict(key)['result'], count)
+                      for key, count in requests.items()
+                      if dict(key)['cache'] == name)
+        total = sum(counts.values())
+        served = counts.get('hit', 0) + counts.get('stale', 0)
+        stats = cache.get_stats()
+        lines.append(' ' + name + ': ' +
+                     '{:.1f}% hit rate'.format(100.0 * served / total
+                                               if total else 0.0) +
+                     ' (' + ', '.join(result + ' ' + str(counts[result])
+                                      for result in sorted(counts)) + '), ' +
+                     str(stats['entries']) + ' entries, ' +
+                     '{:.1f} KiB'.format(stats['bytes'] / 1024.0))
+
+    lines.append('Scrapes (count, p50, p95):')
+    scrapes = metrics.registry.get_histograms('scrape_seconds')
+    for key in sorted(scrapes):
+        labels = dict(key)
+        histogram = scrapes[key]
+        lines.append(' ' + labels['scraper'] + ' ' + labels['phase'] + ': ' +
+                     str(histogram.count) + ', ' +
+                     '{:.3f}s, {:.3f}s'.format(histogram.quantile(0.5),
+                                               histogram.quantile(0.95)))
+
+    dbs = databases
+    changes = dbs.changes
+    lines.append('Databases: version ' + str(dbs.version) + ', ' +
+                 str(len(dbs.coins)) + ' coins, ' +
+                 str(len(dbs.exchanges)) + ' exchanges')
+    for name in sorted(changes):
+        lines.append(' ' + name + ' last update: ' +
+                     ', '.join(key + ' ' + str(changes[name][key])
+                               for key in ('added', 'removed', 'changed')))
+
+    crawl = market_crawl
+    requests = metrics.registry.get_counters('crawl_requests_total')
+    counts = dict((dict(key)['result'], count)
+                  for key, count in requests.items())
+    if crawl is not None:
+        lines.append('Crawl: ' + str(len(crawl)) + ' coins, ' +
+                     formatAge(crawl.age()) + ' old, ' +
+                     str(counts.get('hit', 0)) + ' served, ' +
+                     str(counts.get('miss', 0)) + ' fell back to updateCoin')
+
+    stats = httpclient.client.limiter.get_stats()
+    lines.append('CMC limiter: ' + '{:g}/s, '.format(stats['rate']) +
+                 '{:.1f}/{} tokens'.format(stats['tokens'], stats['burst']))
+    for name in httpclient.LANES:
+        lane = stats['lanes'][name]
+        lines.append(' ' + name + ': ' + str(lane['granted']) +
+                     ' requests, ' + str(lane['waiting']) + ' waiting, ' +
+                     '{:.1f}s waited'.format(lane['wait_seconds']))
+
+    stats = workers.pool.get_stats()
+    lines.append('Workers: ' + str(stats['workers']) + ', ' +
+                 str(stats['running']) + ' running, ' +
+                 str(stats['queued']) + ' queued, ' +
+                 str(stats['rejected']) + ' rejected, ' +
+                 str(stats['throttled']) + ' throttled, ' +
+                 str(stats['timed_out']) + ' timed out')
+
+    stats = update_flight.get_stats()
+    lines.append('Updates: ' + str(stats['calls']) + ' calls, ' +
+                 str(stats['coalesced']) + ' coalesced, ' +
+                 str(stats['in_flight']) + ' in flight')
+
+    lines.append('HTTP (count, avg, max, retries):')
+    endpoints = dict()
+    for url, latency in httpclient.client.get_stats().items():
+        endpoint = getEndpoint(url[len(CMC_URL):])
+        total = endpoints.setdefault(endpoint, {'count': 0, 'seconds': 0.0,
+                                                'max': 0.0, 'retries': 0})
+        total['count'] = total['count'] + latency['count']
+        total['seconds'] = total['seconds'] + \
+            latency['avg'] * latency['count']
+        total['max'] = max(total['max'], latency['max'])
+        total['retries'] = total['retries'] + latency['retries']
+    for endpoint, total in sorted(endpoints.items()):
+        lines.append(' ' + endpoint + ': ' + str(total['count']) + ', ' +
+                     '{:.3f}s, {:.3f}s, '.format(
+                         total['seconds'] / total['count']
+                         if total['count'] else 0.0, total['max']) +
+                     str(total['retries']))
+    return lines
 
 ##################################
 #   Telegram Wrapper Functions   #
 ##################################\
 
+# Updates coin_database and exchange_database, prefetches the top coins and
+# saves the snapshot. The requests are sent in the background lane so that
+# the commands of users go first.
+def updateDatabases(trigger):
+    global last_db_update
+    with httpclient.lane('background'), \
+         metrics.Timer('db_refresh_seconds', trigger=trigger):
+        updateCoinDB()
+        prefetch.startPrefetch()
+        updateExchangeDB()
+    last_db_update = time.time()
+    saveSnapshot()
+
 # Command to update coin_database and exchange_database manually
 def autoUpdateDBWrapper(bot, update):
-    print("automatically updating DB")
-    updateCoinDB(coin_database)
-    updateExchangeDB(exchange_database)
+    update_flight.do(('database', 'update'), updateDatabases, 'auto')
 
-# Command to update coin_database and exchange_database manually
+# Command to update coin_database and exchange_database manually. Updates
+# asked for while one is running wait for it, and updates asked for within
+# UPDATE_DB_MIN_INTERVAL seconds of the last one are refused.
 def manualUpdateDBWrapper(bot, update):
+    age = time.time() - last_db_update
+    if age < UPDATE_DB_MIN_INTERVAL:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='The databases were updated ' +
+                         formatAge(age) + ' ago, please try again in ' +
+                         formatAge(UPDATE_DB_MIN_INTERVAL - age) + '.')
+        return
     bot.send_message(chat_id=update.message.chat_id,
                      text='Updating coin and exchange databases...')
-    updateCoinDB(coin_database)
-    updateExchangeDB(exchange_database)
+    update_flight.do(('database', 'update'), updateDatabases, 'manual')
     bot.send_message(chat_id=update.message.chat_id, text='Update complete!')
 
 # Command to find the coins with the highest volume for this exchange
 def exchangeWrapper(bot, update, args):
-    print()
-
-    if len(args) != 1:
+    if len(args) < 1:
         bot.send_message(chat_id=update.message.chat_id,
-                         text='Too few / many arguments! Please enter only 1' +
+                         text='Too few arguments! Please enter an' +
                          ' exchange name.',
                          reply_to_message_id=update.message.message_id)
     else:
 
-        # Getting the id equivalent (full name delimited with '-') of the
-        # target exchange
-        exchange = args[0].lower()
+        # Resolve the name provided, which may contain spaces e.g. Binance DEX,
+        # to the id of the exchange
+        name = ' '.join(args)
+        exchange = databases.exchanges.resolve(name)
 
         # Checks to see if the name provided is a valid exchange name
-        if exchange in exchange_database:
+        if exchange is not None:
 
             # If so, then get the trading pairs with the highest rolling 24 hour
             # trade volume
-            coins = getCoinsWithCache(exchange, exchange_to_coin)
-            exchange_rank = exchange_to_coin[exchange][0]
-            exchange_vol = exchange_to_coin[exchange][1]
-            exchange_url = exchange_to_coin[exchange][2]
-            results = parseCoin(coins)
-
-            list_of_trading_pairs = ["Name: [" + args[0] + "](" + 
-                                     exchange_url + ")", "Rank: " + 
-                                     exchange_rank, "Volume: " + exchange_vol,
-                                     "", "Coin | Trading Pair | Vol | Price"]
-
-            if results:
-                print("Printing trading pairs...")
-
-                # list_of_exchanges is a list of concatenated exchanges into
-                # strings with a maximum length of 4096 characters, see
-                # comments in the concatExchange Function as to why this isn't
-                # necessary for now.
-
-                for i in results:
-                    name = i[0]
-                    trading_pair = i[1]
-                    vol = '${:,}'.format(i[2])
-                    price = '${:,}'.format(i[3])
-                    url = i[4]
-
-                    list_of_trading_pairs.append(name + " | " + "[" + 
-                                                 trading_pair + "](" + url +
-                                                  ") | " + vol + " | " + price)
-
-                bot.send_message(chat_id=update.message.chat_id,
-                                 text=concatExchanges(list_of_trading_pairs),
-                                 disable_web_page_preview=True,
-                                 parse_mode='Markdown',
-                                 reply_to_message_id=update.message.message_id)
+            # Read the entry once so that every part of the reply comes from
+            # the same update
+            getCoinsWithCache(exchange, exchange_to_coin)
+            try:
+                entry = exchange_to_coin.peek(exchange)
+            except KeyError:
+                entry = None
+
+            if entry and entry[3]:
+                exchange_rank, exchange_vol, exchange_url, coins = entry[:4]
+
+                def render():
+                    results = parseCoin(coins)
+                    header = ["Name: [" + name + "](" + exchange_url + ")",
+                              "Rank: " + exchange_rank,
+                              "Volume: " + exchange_vol,
+                              "", "Coin | Trading Pair | Vol | Price"]
+                    list_of_trading_pairs = []
+
+                    # list_of_trading_pairs is split into messages of at
+                    # most 4096 characters by concatExchanges
+                    for i in results:
+                        coin_name = i[0]
+                        trading_pair = i[1]
+                        vol = '${:,}'.format(i[2])
+                        price = '${:,}'.format(i[3])
+                        url = i[4]
+
+                        list_of_trading_pairs.append(
+                            coin_name + " | " + "[" + trading_pair + "](" +
+                            url + ") | " + vol + " | " + price)
+                    if not results:
+                        return []
+                    return concatExchanges(header, list_of_trading_pairs)
+
+                render_id, pages = getRenderedPages(('e', name, exchange,
+                                                     entry[4]), render)
+                if pages:
+                    sendPages(bot, update, render_id, pages)
 
         else:
-            print(args[0] + " not found!")
+            tracing.log(logger, logging.INFO, 'exchange not found', name=name)
+
+            # Suggest the closest exchanges in case of a typo
+            suggestions = databases.exchanges.suggest(name)
+            if suggestions:
+                hint = " Did you mean " + ", ".join(suggestions) + "?"
+            else:
+                hint = ""
             bot.send_message(chat_id=update.message.chat_id,
-                             text=args[0] + " cannot be found in DB, please" +
+                             text=name + " cannot be found in DB, please" +
                              " check that you've entered a valid exchange" + 
                              " name or run the updateDB command. Note that" +
                              " coinmarketcap is the data source i.e. your" +
                              " name has to be listed on CMC before the bot" +
-                             " can pull its data.",
+                             " can pull its data." + hint,
                              reply_to_message_id=update.message.message_id)
 
 # Command to find all exchanges that trades this coin
 def coinWrapper(bot, update, args):
-    print()
-
     if len(args) != 1:
         bot.send_message(chat_id=update.message.chat_id,
                          text='Too few / many arguments! Please enter only 1' +
@@ -592,9 +1892,9 @@ def coinWrapper(bot, update, args):
         coin = args[0].upper()
 
         try:
-            coin_database[coin]
+            databases.coins[coin]
         except KeyError:
-            print(args[0] + " not found!")
+            tracing.log(logger, logging.INFO, 'coin not found', coin=coin)
             bot.send_message(chat_id=update.message.chat_id,
                              text=args[0] + " cannot be found in DB, please" +
                              " check that you've entered a valid ticker or" +
@@ -604,33 +1904,32 @@ def coinWrapper(bot, update, args):
                              " can pull its data.",
                              reply_to_message_id=update.message.message_id)
         else:
-            # Get the top 10 exchanges in terms of volume
-            exchanges = getExchangeWithCache(coin, coin_to_exchanges)[:10]
-
-            if exchanges:
-                print("Printing exchanges...")
-
-                # list_of_exchanges is a list of concatenated exchanges into
-                # strings with a maximum length of 4096 characters, see
-                # comments in the concatExchange Function as to why this isn't
-                # necessary for now.
-                list_of_exchanges = ["Exchange | Volume"]
-
-                for exchange in exchanges:
-                    name = exchange[0]
-                    vol = '${:,}'.format(exchange[1].total_vol)
-                    url = exchange[1].get_details()[0]['url']
-                    list_of_exchanges.append(
-                        "[" + name + "](" + url + ") | " + vol)
-
-                bot.send_message(chat_id=update.message.chat_id,
-                                 text=concatExchanges(list_of_exchanges),
-                                 disable_web_page_preview=True,
-                                 parse_mode='Markdown',
-                                 reply_to_message_id=update.message.message_id)
-                # for i in list_of_exchanges:
-                # bot.send_message(chat_id=update.message.chat_id, text=i,
-                # reply_to_message_id=update.message.message_id)
+            # Get the exchanges in terms of volume, 10 per page
+            # Read the entry once so that the markets and their time of update
+            # come from the same update
+            getExchangeWithCache(coin, coin_to_exchanges)
+            try:
+                exchanges, time_of_update = coin_to_exchanges.peek(coin)[:2]
+            except KeyError:
+                exchanges, time_of_update = False, None
+
+            if exchanges and time_of_update:
+
+                def render():
+                    list_of_exchanges = []
+                    for exchange in exchanges.top(len(exchanges.names)):
+                        name = exchange[0]
+                        vol = '${:,}'.format(exchange[1])
+                        url = exchange[2]
+                        list_of_exchanges.append(
+                            "[" + name + "](" + url + ") | " + vol)
+                    return concatExchanges(["Exchange | Volume"],
+                                           list_of_exchanges,
+                                           PAGE_ROWS)
+
+                render_id, pages = getRenderedPages(('c', coin,
+                                                     time_of_update), render)
+                sendPages(bot, update, render_id, pages)
 
 # Find the most expensive trading pairs from the top 10 exchanges that trades
 # this coin
@@ -643,7 +1942,6 @@ def cheapestWrapper(bot, update, args):
 
 # Refactored this function as it is repeated.
 def minOrMax(bot, update, args, order):
-    print()
     if len(args) < 1 or len(args) > 2:
         bot.send_message(chat_id=update.message.chat_id,
                          text='Too few / many arguments! Please enter either' +
@@ -658,9 +1956,9 @@ def minOrMax(bot, update, args, order):
         coin = args[0].upper()
 
         try:
-            coin_database[coin]
+            databases.coins[coin]
         except KeyError:
-            print(args[0] + " not found!")
+            tracing.log(logger, logging.INFO, 'coin not found', coin=coin)
             bot.send_message(chat_id=update.message.chat_id,
                              text=args[0] + " cannot be found in DB, please" +
                              " check that you've entered a valid ticker or" +
@@ -670,26 +1968,31 @@ def minOrMax(bot, update, args, order):
                              " can pull its data.",
                              reply_to_message_id=update.message.message_id)
         else:
-            exchanges = getExchangeWithCache(coin, coin_to_exchanges)
+            # Read the entry once so that the markets and their time of update
+            # come from the same update
+            getExchangeWithCache(coin, coin_to_exchanges)
+            try:
+                exchanges, time_of_update = coin_to_exchanges.peek(coin)[:2]
+            except KeyError:
+                exchanges, time_of_update = False, None
 
             # If an additional ticker parameter is provided
             if len(args) == 2:
-                print(args[1])
-                results = parseExchange(exchanges,
-                                        order=order,
-                                        ticker=args[1].upper())
+                ticker = args[1].upper()
             else:
-                results = parseExchange(exchanges, order=order)
-
-            if results:
-                print("Printing trading pairs...")
-
-                # list_of_exchanges is a list of concatenated exchanges into
-                # strings with a maximum length of 4096 characters, see
-                # comments in the concatExchange Function as to why this isn't
-                # necessary for now.
-                trading_pairs = ["Exchange | Trading Pair | Volume | Price"]
+                ticker = None
 
+            def render():
+                results = parseExchange(exchanges,
+                                        order=order,
+                                        ticker=ticker,
+                                        limit=PRICE_RESULTS)
+                if not results:
+                    return []
+
+                # trading_pairs is split into pages of PAGE_ROWS by
+                # concatExchanges
+                trading_pairs = []
                 for i in results:
                     name = i[0]
                     trading_pair = i[1]
@@ -697,15 +2000,22 @@ def minOrMax(bot, update, args, order):
                     price = '${:,}'.format(i[3])
                     url = i[4]
 
-                    trading_pairs.append( 
+                    trading_pairs.append(
                         name + " | " + "[" + trading_pair + "](" + url + ") | "
                         + vol + " | " + price)
+                return concatExchanges(
+                    ["Exchange | Trading Pair | Volume | Price"],
+                    trading_pairs,
+                    PAGE_ROWS)
+
+            if exchanges and time_of_update:
+                render_id, pages = getRenderedPages((order, coin, ticker,
+                                                     time_of_update), render)
+            else:
+                pages = []
 
-                bot.send_message(chat_id=update.message.chat_id,
-                                 text=concatExchanges(trading_pairs),
-                                 disable_web_page_preview=True,
-                                 parse_mode='Markdown',
-                                 reply_to_message_id=update.message.message_id)
+            if pages:
+                sendPages(bot, update, render_id, pages)
             else:
                 bot.send_message(chat_id=update.message.chat_id,
                                  text='Invalid ticker filter provided, please' +
@@ -714,11 +2024,297 @@ def minOrMax(bot, update, args, order):
                                  parse_mode='Markdown',
                                  reply_to_message_id=update.message.message_id)
 
+# Callback of the previous / next buttons of a paginated reply. The page is
+# served from rendered_cache, a reply whose pages were evicted or rendered from
+# data that has since been updated has to be asked for again.
+def pageWrapper(bot, update):
+    query = update.callback_query
+    try:
+        prefix, render_id, page = query.data.split(':')
+        page = int(page)
+    except ValueError:
+        query.answer()
+        return
+
+    entry = rendered_cache.get(render_id)
+    if entry is None or not 0 <= page < len(entry[1]):
+        countCacheRequest('rendered', render_id, 'expired')
+        query.answer(text='These results have expired, please run the' +
+                     ' command again.')
+        return
+
+    pages = entry[1]
+    with tracing.span('send', command='page', page=page):
+        bot.edit_message_text(text=pages[page],
+                              chat_id=query.message.chat_id,
+                              message_id=query.message.message_id,
+                              disable_web_page_preview=True,
+                              parse_mode='Markdown',
+                              reply_markup=getPageKeyboard(render_id, page,
+                                                           len(pages)))
+    query.answer()
+
+# Formats a factor returned by analyse, nan when the price did not move
+def formatFactor(value):
+    return 'n/a' if math.isnan(value) else '{:,.2f}'.format(value)
+
+# Command to analyse if a coin is getting pumped
+def analyseWrapper(bot, update, args):
+    if len(args) < 2:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='Too few arguments! Please enter 1 ticker' +
+                         ' followed by number of days and optionally an' +
+                         ' exchange e.g. /analyse CND 7 or /analyse CND 7' +
+                         ' binance',
+                         reply_to_message_id=update.message.message_id)
+        return
+
+    coin = args[0].upper()
+    try:
+        days = float(args[1])
+        days = int(round(days)) if math.isfinite(days) and days > 0 else 0
+    except (ValueError, OverflowError):
+        days = 0
+
+    if coin not in databases.coins or not 2 <= days <= ANALYSE_MAX_DAYS:
+        tracing.log(logger, logging.INFO, 'invalid analyse parameters',
+                    coin=coin, days=args[1])
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=args[0] + " cannot be found in DB or the" +
+                         " number of days is not between 2 and " +
+                         str(ANALYSE_MAX_DAYS) + ", please run the updateDB" +
+                         " command or check that you've entered valid" +
+                         " parameters.",
+                         reply_to_message_id=update.message.message_id)
+        return
+
+    # The markets of one exchange are only known from the recorded history
+    exchange = None
+    if len(args) > 2:
+        exchange = getRecordedExchange(coin, ' '.join(args[2:]), days)
+        if exchange is None:
+            bot.send_message(chat_id=update.message.chat_id,
+                             text='No markets of ' + coin + ' on ' +
+                             ' '.join(args[2:]) + ' have been recorded in' +
+                             ' the last ' + str(days) + ' days.',
+                             reply_to_message_id=update.message.message_id)
+            return
+
+    # The dates of the historical data page may not be in the expected format
+    try:
+        results = analyse(coin, days, exchange)
+    except ValueError as e:
+        tracing.log(logger, logging.WARNING, 'error reading history',
+                    coin=coin, error=e)
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='The history of ' + coin + ' could not be' +
+                         ' read, please try again later.',
+                         reply_to_message_id=update.message.message_id)
+        return
+    if 'factor' not in results:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='Not enough history to analyse ' + coin +
+                         ', please try again later.',
+                         reply_to_message_id=update.message.message_id)
+        return
+
+    with tracing.span('render', coin=coin):
+        text = '\n'.join([
+            "Accumulation of " + coin +
+            (" on " + exchange if exchange else "") + " over " +
+            str(results['days']) + " days",
+            "Factor: " + formatFactor(results['factor']) +
+            " (volume " + '{:+.1%}'.format(results['volume_change']) +
+            ", price " + '{:+.1%}'.format(results['price_change']) + ")",
+            "Mean daily factor: " + formatFactor(results['mean']) +
+            " (absolute " + formatFactor(results['mean_abs']) + ")",
+            "Mean daily factor of the last " +
+            str(results['trailing_days']) + " days: " +
+            formatFactor(results['trailing']) +
+            " (absolute " + formatFactor(results['trailing_abs']) + ")"])
+
+    with tracing.span('send', coin=coin):
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=text,
+                         reply_to_message_id=update.message.message_id)
+
+# Maximum number of coins listed per section by /diff
+DIFF_MAX_COINS = 50
+
+# The listings come from the all exchanges volume page, which only shows the
+# top traded pairs of every exchange
+DIFF_NOTE = "Only the top traded pairs of each exchange are compared, so a" + \
+    " coin listed as only on one exchange may still trade on the other."
+
+# Splits args into the names of two exchanges, which may contain spaces e.g.
+# /diff binance dex kucoin. Returns None if no split resolves both.
+def splitExchanges(args):
+    exchanges = databases.exchanges
+    for i in range(1, len(args)):
+        first = exchanges.resolve(' '.join(args[:i]))
+        second = exchanges.resolve(' '.join(args[i:]))
+        if first is not None and second is not None:
+            return first, second
+    return None
+
+# Formats a section of /diff, listing at most DIFF_MAX_COINS coins
+def formatCoins(title, coins):
+    coins = sorted(coins, key=lambda coin: coin.lower())
+    text = title + " (" + str(len(coins)) + "): "
+    if not coins:
+        return text + "none"
+    text = text + ", ".join(coins[:DIFF_MAX_COINS])
+    if len(coins) > DIFF_MAX_COINS:
+        text = text + " and " + str(len(coins) - DIFF_MAX_COINS) + " more"
+    return text
+
+# Command to compare the coins listed on 2 exchanges
+def diffWrapper(bot, update, args):
+    exchanges = splitExchanges(args)
+    if exchanges is None:
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='Please enter 2 valid exchange names e.g.' +
+                         ' /diff binance kucoin',
+                         reply_to_message_id=update.message.message_id)
+        return
+
+    first, second = exchanges
+    with tracing.span('render', first=first, second=second):
+        listings = listing_index.diff(first, second)
+        if listings is None:
+            text = "The coins listed on " + first + " and " + second + \
+                " are not known yet, please run the updateDB command."
+        else:
+            both, only_first, only_second = listings
+            text = '\n\n'.join([formatCoins("Listed on both", both),
+                                 formatCoins("Only on " + first, only_first),
+                                 formatCoins("Only on " + second,
+                                             only_second),
+                                 DIFF_NOTE])
+
+    with tracing.span('send', first=first, second=second):
+        bot.send_message(chat_id=update.message.chat_id,
+                         text=text,
+                         reply_to_message_id=update.message.message_id)
+
+# Number of coins listed by /scan
+SCAN_TOP_N = 10
+
+# Formats a duration in seconds as e.g. 2h 5m
+def formatAge(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return str(minutes) + 'm'
+    return str(minutes // 60) + 'h ' + str(minutes % 60) + 'm'
+
+# Command to list the coins with the highest accumulation factor from the
+# latest scan of every coin
+def scanWrapper(bot, update):
+    result = scanner.latest
+    progress = scanner.progress
+    lines = []
+
+    if result is not None:
+        with tracing.span('render', command='scan'):
+            lines.append("Top accumulation over " + str(result.days) +
+                         " days (" + str(result.coins) + " coins scanned " +
+                         formatAge(result.age()) + " ago)")
+            lines.append("Coin | Factor | Volume | Price")
+            for coin, score, results in result.ranking[:SCAN_TOP_N]:
+                lines.append(coin + " | " + formatFactor(score) + " | " +
+                             '{:+.1%}'.format(results['volume_change']) +
+                             " | " +
+                             '{:+.1%}'.format(results['price_change']))
+    if progress['running']:
+        lines.append("Scan in progress: " + str(progress['done']) + "/" +
+                     str(progress['total']) + " coins")
+    elif result is None:
+        scanner.startScan()
+        lines.append("Scanning every coin, please try again in a few" +
+                     " minutes.")
+
+    with tracing.span('send', command='scan'):
+        bot.send_message(chat_id=update.message.chat_id,
+                         text='\n'.join(lines),
+                         reply_to_message_id=update.message.message_id)
+
+# Job to refresh the exchange snapshot and crawl the markets of every coin
+# from it
+def crawlWrapper(bot, job):
+    try:
+        with httpclient.lane('background'):
+            update_flight.do(('snapshot', 'exchanges'),
+                             updateExchangeSnapshot)
+            getMarketCrawl()
+    except Exception as e:
+        tracing.log(logger, logging.ERROR, 'error crawling markets', error=e)
+
+# Job to scan every coin for accumulation
+def autoScanWrapper(bot, job):
+    scanner.startScan()
+
+# Command to show the runtime metrics of the bot to its admins
+def statsWrapper(bot, update):
+    if not isAdmin(update):
+        tracing.log(logger, logging.WARNING, 'ignoring admin command',
+                    command='stats', user=update.message.from_user.id)
+        return
+    updateMetricGauges()
+
+    # Kept in rendered_cache only for the page buttons, every /stats renders
+    # its own pages
+    key = ('stats', time.time())
+    pages = concatExchanges([], [escapeMarkdown(line)
+                                 for line in formatStats()])
+    render_id = getRenderId(key)
+    rendered_cache[render_id] = (key, pages)
+    sendPages(bot, update, render_id, pages)
+
+# Command to show or set the fraction of commands run under cProfile e.g.
+# /profile 0.05 profiles 5% of commands, /profile 0 stops profiling
+def profileWrapper(bot, update, args):
+    if not isAdmin(update):
+        tracing.log(logger, logging.WARNING, 'ignoring admin command',
+                    command='profile', user=update.message.from_user.id)
+        return
+    if len(args) == 1:
+        try:
+            tracing.setProfileRate(float(args[0]))
+        except ValueError:
+            bot.send_message(chat_id=update.message.chat_id,
+                             text='Please enter a fraction between 0 and 1' +
+                             ' e.g. /profile 0.05',
+                             reply_to_message_id=update.message.message_id)
+            return
+    bot.send_message(chat_id=update.message.chat_id,
+                     text='Profiling ' +
+                     '{:g}%'.format(tracing.PROFILE_RATE * 100) +
+                     ' of commands into ' + tracing.PROFILE_DIR + '/',
+                     reply_to_message_id=update.message.message_id)
+
+# Job to write the metrics to METRICS_FILE
+def writeMetricsWrapper(bot, job):
+    updateMetricGauges()
+    try:
+        metrics.writePrometheus(METRICS_FILE)
+    except (IOError, OSError) as e:
+        tracing.log(logger, logging.ERROR, 'error writing metrics', error=e)
+
+# Seconds between prunes of the history store
+HISTORY_PRUNE_INTERVAL = 86400
+
+# Job to delete the history that is too old or over the size limit
+def pruneHistoryWrapper(bot, job):
+    try:
+        history.store.prune()
+    except (IOError, OSError) as e:
+        tracing.log(logger, logging.ERROR, 'error pruning history', error=e)
+
 # Command to introduce the bot to the users
 def startWrapper(bot, update):
 
     bot.send_message(chat_id=update.message.chat_id,
-                     text="Hi and welcome to the exchange explorer bot! The 4" +
+                     text="Hi and welcome to the exchange explorer bot! The 7" +
                      " main commands that are supported by this bot are:\n\n" +
                      " 1. /c ticker - To determine the exchanges available" +
                      " and the cumulative 24 hour rolling trade volume for a" +
@@ -728,9 +2324,19 @@ def startWrapper(bot, update):
                      " /min BTC **\n3. /max ticker [filter] - To determine" + 
                      " the most expensive exchange and its corresponding" + 
                      " trading pair for a given ticker e.g. /max BTC USD **\n" +
+                     " Add * to the filter to include stablecoins e.g." +
+                     " /min BTC USD*\n" +
                      " 4. /e exchange_name - To determine the cumulative 24" +
                      " hour rolling trade volume, rank and its top traded" +
-                     " pairs for the specified exchange e.g. /e binance\n\n" +
+                     " pairs for the specified exchange e.g. /e binance\n" +
+                     " 5. /analyse ticker days [exchange] - To determine the" +
+                     " accumulation factor (% change in volume over % change" +
+                     " in price) of a ticker over the last days, optionally" +
+                     " on one exchange e.g. /analyse CND 30\n" +
+                     " 6. /scan - To list the coins with the highest" +
+                     " accumulation factor over the last 30 days\n" +
+                     " 7. /diff exchange_1 exchange_2 - To compare the coins" +
+                     " listed on 2 exchanges e.g. /diff binance kucoin\n\n" +
                      " ** Filter is optional.\n\nThis bot is created by" + 
                      " @itsmest. If you have any feedback or suggestions," +
                      " feel free to drop me a message!.")
@@ -792,32 +2398,3 @@ def startWrapper(bot, update):
 #                "404 Error: Command not found!"]
 #     bot.send_message(chat_id=update.message.chat_id, text=replies[randint(
 #         0, 4)], reply_to_message_id=update.message.message_id)
-
-# Command to analyse if a coin is getting pumped
-# def analyseWrapper(bot, update, args):
-#     print()
-#     if len(args) != 2:
-#         bot.send_message(chat_id=update.message.chat_id,
-#                          text='Too few / many arguments! Please enter 1' +
-#                          'ticker followed by number of days e.g. /analyse' +
-#                          ' CND 7',
-#                          reply_to_message_id=update.message.message_id)
-#     else:
-#         # Getting the id equivalent (full name delimited with '-') of the
-#         # target coin
-#         coin = args[0].upper()
-#         day = round(float(args[1]))
-#         if (coin in coin_database) and day > 0:
-#             id = coin_database[coin].get('id')
-#             accumulationFactor = analyse(id, day)
-#             bot.send_message(chat_id=update.message.chat_id,
-#                              text=accumulationFactor,
-#                              reply_to_message_id=update.message.message_id)
-
-#         else:
-#             print("Invalid parameters or updateCoinDB not run!")
-#             bot.send_message(chat_id=update.message.chat_id,
-#                              text=args[0] + " cannot be found in DB, please" +
-#                              " run the updateCoinDB command or check that you've"+
-#                              " entered valid parameters.",
-#                              reply_to_message_id=update.message.message_id)
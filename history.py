@@ -0,0 +1,431 @@
+import itertools
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Append-only store of every markets snapshot fetched by updateCoin, kept for
+# the accumulation tracker (see Notes.txt).
+#
+# Snapshots are stored per coin in one segment file per UTC day e.g.
+# history/BTC/20181018.seg, so a range query only opens the days it covers.
+# A segment starts with SEGMENT_MAGIC and the format version followed by
+# blocks, one per snapshot. Every block starts with BLOCK_HEADER:
+#
+#   payload length, rows, timestamp, volume weighted price, lowest price,
+#   highest price, total 24h volume
+#
+# so that price and volume history can be read from the headers alone. The
+# payload stores the snapshot column by column as varints:
+#
+#   groups, exchange ids, rows per exchange, pair ids, price deltas,
+#   volume deltas
+#
+# Prices are stored in units of 1 / PRICE_SCALE. Prices and volumes are stored
+# as zigzag encoded deltas from the previous row since neighbouring rows are
+# close. Exchange and pair names are stored as ids into the coin's names file,
+# which has one name per line and is only ever appended to.
+#
+# Segments are read through mmap so only the pages of the blocks a query
+# touches are loaded from disk.
+#
+# prune, run once a day by the bot, deletes the segments older than
+# HISTORY_RETENTION_DAYS, then the oldest days of every coin until the store
+# fits in HISTORY_MAX_BYTES.
+
+HISTORY_DIR = os.environ.get('EXCHANGEBOT_HISTORY_DIR', 'history')
+HISTORY_RETENTION_DAYS = int(os.environ.get('EXCHANGEBOT_HISTORY_DAYS',
+                                            '730'))
+HISTORY_MAX_BYTES = int(os.environ.get('EXCHANGEBOT_HISTORY_MAX_MB',
+                                       '2048')) * 2 ** 20
+
+SEGMENT_MAGIC = b'EXHS'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sH')
+BLOCK_HEADER = struct.Struct('<IIddddq')
+
+PRICE_SCALE = 10 ** 8
+
+# Encodes unsigned integers as little endian base 128 varints into out
+def encodeVarints(values, out):
+    for value in values:
+        while value > 0x7f:
+            out.append((value & 0x7f) | 0x80)
+            value = value >> 7
+        out.append(value)
+
+# Decodes count varints from buf starting at offset. Returns the values and the
+# offset after the last one.
+def decodeVarints(buf, offset, count):
+    values = []
+    for i in range(count):
+        value = 0
+        shift = 0
+        while True:
+            byte = buf[offset]
+            offset = offset + 1
+            value = value | ((byte & 0x7f) << shift)
+            if byte < 0x80:
+                break
+            shift = shift + 7
+        values.append(value)
+    return values, offset
+
+# Maps signed integers to unsigned ones so that small negative deltas also
+# encode to short varints
+def encodeDeltas(values):
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        yield (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+
+def decodeDeltas(values):
+    results = []
+    previous = 0
+    for value in values:
+        previous = previous + ((value >> 1) if not value & 1
+                               else -((value + 1) >> 1))
+        results.append(previous)
+    return results
+
+# Returns the UTC day of timestamp as YYYYMMDD
+def getDay(timestamp):
+    return time.strftime('%Y%m%d', time.gmtime(timestamp))
+
+# Class to represent the names file of one coin
+class Names:
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.ids = dict()
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    self.add(line.rstrip('\n'))
+        except IOError:
+            pass
+
+    def add(self, name):
+        self.ids[name] = len(self.names)
+        self.names.append(name)
+
+    # Returns the ids of names, appending the new names to the file first
+    def get_ids(self, names):
+        new_names = []
+        for name in names:
+            if name not in self.ids:
+                self.add(name)
+                new_names.append(name)
+        if new_names:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(name + '\n' for name in new_names))
+        return [self.ids[name] for name in names]
+
+# Class to represent the history of every coin under directory
+class HistoryStore:
+
+    def __init__(self, directory=HISTORY_DIR,
+                 retention_days=HISTORY_RETENTION_DAYS,
+                 max_bytes=HISTORY_MAX_BYTES):
+        self.directory = directory
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.names = dict()
+
+        # Length of the valid blocks of every segment written to since start
+        self.lengths = dict()
+
+    def coin_dir(self, coin):
+        return os.path.join(self.directory,
+                            re.sub(r'[^A-Za-z0-9_.-]', '_', coin))
+
+    def get_names(self, coin):
+        try:
+            return self.names[coin]
+        except KeyError:
+            names = Names(os.path.join(self.coin_dir(coin), 'names.txt'))
+            self.names[coin] = names
+            return names
+
+    # Returns the length of the segment at path up to its last complete block.
+    # A block cut off by a crash is dropped on the next write.
+    def valid_length(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        with open(path, 'rb') as f:
+            if size < SEGMENT_HEADER.size:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                offset = SEGMENT_HEADER.size
+                while offset + BLOCK_HEADER.size <= size:
+                    length = BLOCK_HEADER.unpack_from(buf, offset)[0]
+                    end = offset + BLOCK_HEADER.size + length
+                    if end > size:
+                        break
+                    offset = end
+        return offset
+
+    # Appends a snapshot of table, the MarketTable of the markets of coin
+    # grouped by exchange, to the segment of its day
+    def record(self, coin, table, timestamp=None):
+        if not self.enabled or len(table.prices) == 0:
+            return False
+        if timestamp is None:
+            timestamp = time.time()
+
+        prices = [int(round(price * PRICE_SCALE)) for price in table.prices]
+        volume = sum(table.vols)
+        if volume > 0:
+            vwap = sum(price * vol for price, vol
+                       in zip(table.prices, table.vols)) / volume
+        else:
+            vwap = sum(table.prices) / len(table.prices)
+
+        with self.lock:
+            directory = self.coin_dir(coin)
+            os.makedirs(directory, exist_ok=True)
+            names = self.get_names(coin)
+            exchange_ids = names.get_ids(table.names)
+            pair_ids = names.get_ids(table.pairs)
+
+            payload = bytearray()
+            encodeVarints([len(table.names)], payload)
+            encodeVarints(exchange_ids, payload)
+            encodeVarints([table.offsets[i + 1] - table.offsets[i]
+                           for i in range(len(table.names))], payload)
+            encodeVarints([pair_ids[j] for j in table.pair_ids], payload)
+            encodeVarints(encodeDeltas(prices), payload)
+            encodeVarints(encodeDeltas(table.vols), payload)
+
+            path = os.path.join(directory, getDay(timestamp) + '.seg')
+            try:
+                length = self.lengths[path]
+            except KeyError:
+                length = self.valid_length(path)
+
+            with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                if length == 0:
+                    f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC,
+                                                SEGMENT_VERSION))
+                    length = SEGMENT_HEADER.size
+                f.seek(length)
+                f.truncate()
+                f.write(BLOCK_HEADER.pack(len(payload),
+                                          len(table.prices),
+                                          timestamp,
+                                          vwap,
+                                          min(table.prices),
+                                          max(table.prices),
+                                          volume))
+                f.write(payload)
+            self.lengths[path] = length + BLOCK_HEADER.size + len(payload)
+        return True
+
+    # Yields (buf, offset of the payload, header) for the blocks of coin
+    # recorded between start and end, oldest first
+    def blocks(self, coin, start, end):
+        directory = self.coin_dir(coin)
+        try:
+            files = sorted(name for name in os.listdir(directory)
+                           if name.endswith('.seg'))
+        except OSError:
+            return
+
+        first_day = getDay(start)
+        last_day = getDay(end)
+        for name in files:
+            if not first_day <= name[:-len('.seg')] <= last_day:
+                continue
+            with open(os.path.join(directory, name), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < SEGMENT_HEADER.size:
+                    continue
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                    magic, version = SEGMENT_HEADER.unpack_from(buf, 0)
+                    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+                        tracing.log(logger, logging.WARNING,
+                                    'skipping segment', coin=coin, name=name,
+                                    version=version)
+                        continue
+
+                    offset = SEGMENT_HEADER.size
+                    while offset + BLOCK_HEADER.size <= size:
+                        header = BLOCK_HEADER.unpack_from(buf, offset)
+                        payload = offset + BLOCK_HEADER.size
+                        offset = payload + header[0]
+                        if offset > size:
+                            break
+                        if header[2] > end:
+                            break
+                        if header[2] >= start:
+                            yield buf, payload, header
+
+    # Returns the (timestamp, rows, volume weighted price, lowest price,
+    # highest price, total 24h volume) tuples of the snapshots of coin between
+    # start and end. Only the block headers are read unless the snapshots are
+    # limited to the markets of one exchange.
+    def snapshots(self, coin, start=0, end=None, exchange=None):
+        if end is None:
+            end = time.time()
+        if exchange is None:
+            return [header[2:3] + header[1:2] + header[3:]
+                    for buf, offset, header in self.blocks(coin, start, end)]
+
+        results = []
+        for timestamp, markets in itertools.groupby(
+                self.markets(coin, start, end, exchange),
+                key=lambda market: market[0]):
+            markets = list(markets)
+            prices = [market[3] for market in markets]
+            volume = sum(market[4] for market in markets)
+            if volume > 0:
+                vwap = sum(market[3] * market[4]
+                           for market in markets) / volume
+            else:
+                vwap = sum(prices) / len(prices)
+            results.append((timestamp, len(markets), vwap, min(prices),
+                            max(prices), volume))
+        return results
+
+    # Returns the (timestamp, exchange, trading pair, price, vol) tuples of
+    # every market of coin recorded between start and end, optionally only
+    # those of one exchange and one trading pair. Blocks that do not list the
+    # exchange are skipped without decoding their markets.
+    def markets(self, coin, start=0, end=None, exchange=None, pair=None):
+        if end is None:
+            end = time.time()
+        results = []
+
+        with self.lock:
+            names = list(self.get_names(coin).names)
+
+        for buf, offset, header in self.blocks(coin, start, end):
+            rows = header[1]
+            (groups,), offset = decodeVarints(buf, offset, 1)
+            exchange_ids, offset = decodeVarints(buf, offset, groups)
+            counts, offset = decodeVarints(buf, offset, groups)
+
+            if exchange is not None:
+                try:
+                    group = [names[i] for i in exchange_ids].index(exchange)
+                except ValueError:
+                    continue
+                first = sum(counts[:group])
+                last = first + counts[group]
+            else:
+                first = 0
+                last = rows
+
+            pair_ids, offset = decodeVarints(buf, offset, rows)
+            prices, offset = decodeVarints(buf, offset, rows)
+            vols, offset = decodeVarints(buf, offset, rows)
+            prices = decodeDeltas(prices)
+            vols = decodeDeltas(vols)
+
+            exchange_names = []
+            for i in range(groups):
+                exchange_names.extend([names[exchange_ids[i]]] * counts[i])
+            for j in range(first, last):
+                if pair is not None and names[pair_ids[j]] != pair:
+                    continue
+                results.append((header[2],
+                                exchange_names[j],
+                                names[pair_ids[j]],
+                                prices[j] / PRICE_SCALE,
+                                vols[j]))
+        return results
+
+    # Returns the exchange names recorded for coin
+    def exchanges(self, coin, start=0, end=None):
+        if end is None:
+            end = time.time()
+        with self.lock:
+            names = list(self.get_names(coin).names)
+        exchanges = set()
+        for buf, offset, header in self.blocks(coin, start, end):
+            (groups,), offset = decodeVarints(buf, offset, 1)
+            exchange_ids, offset = decodeVarints(buf, offset, groups)
+            exchanges.update(names[i] for i in exchange_ids)
+        return exchanges
+
+    # Deletes the segments of days older than retention_days, then the oldest
+    # days until the segments fit in max_bytes. The segments of today are
+    # never deleted. Returns the number of segments and bytes deleted.
+    def prune(self):
+        today = getDay(time.time())
+        cutoff = getDay(time.time() - self.retention_days * 86400)
+        segments = []
+        try:
+            coins = os.listdir(self.directory)
+        except OSError:
+            return 0, 0
+        for coin in coins:
+            directory = os.path.join(self.directory, coin)
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith('.seg'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    continue
+                segments.append((name[:-len('.seg')], path, size))
+        segments.sort()
+
+        total = sum(size for day, path, size in segments)
+        deleted = 0
+        freed = 0
+        with self.lock:
+            for day, path, size in segments:
+                if day >= today or \
+                   (day >= cutoff and total - freed <= self.max_bytes):
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self.lengths.pop(path, None)
+                deleted = deleted + 1
+                freed = freed + size
+
+        tracing.log(logger, logging.INFO, 'history pruned', segments=deleted,
+                    bytes=freed, remaining=total - freed)
+        return deleted, freed
+
+    # Returns (start of interval, open, high, low, close, 24h volume) tuples
+    # for every interval seconds between start and end that has snapshots.
+    # Prices are the volume weighted prices of the snapshots and the volume is
+    # the 24h volume of the last snapshot in the interval. If exchange is set
+    # only the markets of that exchange are counted.
+    def ohlcv(self, coin, start=0, end=None, interval=86400, exchange=None):
+        results = []
+        for timestamp, rows, vwap, low, high, volume in \
+                self.snapshots(coin, start, end, exchange):
+            bucket = timestamp - (timestamp - start) % interval
+            if results and results[-1][0] == bucket:
+                bar = results[-1]
+                results[-1] = (bucket, bar[1], max(bar[2], vwap),
+                               min(bar[3], vwap), vwap, volume)
+            else:
+                results.append((bucket, vwap, vwap, vwap, vwap, volume))
+        return results
+
+# Shared store that updateCoin records to
+store = HistoryStore()
@@ -0,0 +1,252 @@
+import logging
+import os
+import random
+import threading
+import time
+import requests
+import tracing
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+# Timeouts in seconds for connecting to and reading from CMC
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# Number of retries after the first attempt and the base delay in seconds
+# between them. The delay doubles on every retry and is jittered.
+MAX_RETRIES = 3
+BACKOFF = 0.5
+
+# Responses with these status codes are retried
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Number of pooled connections and concurrent requests per host
+POOL_SIZE = 10
+HOST_CONCURRENCY = 4
+
+# Requests per second that may be sent to CMC across the whole bot, and the
+# number that may be sent at once after a quiet period. Every attempt,
+# retries included, takes a token.
+RATE = float(os.environ.get('EXCHANGEBOT_CMC_RATE', '4'))
+BURST = 8
+
+# Priority lanes of the rate limiter, highest priority first. Requests for a
+# user's command take the tokens before any request of a background refresh,
+# prefetch, crawl or scan.
+LANES = ('user', 'background')
+
+logger = logging.getLogger(__name__)
+
+# Lane of the requests made by the current thread
+context = threading.local()
+
+def getLane():
+    return getattr(context, 'lane', LANES[0])
+
+# Context manager to send the requests of the current thread in lane e.g.
+# with lane('background'): ...
+class lane:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.previous = getLane()
+        context.lane = self.name
+        return self.name
+
+    def __exit__(self, *exc):
+        context.lane = self.previous
+        return False
+
+# Calls fn(*args) with its requests sent in lane name, for work handed to
+# executors
+def runInLane(name, fn, *args):
+    with lane(name):
+        return fn(*args)
+
+# Class to represent a token bucket that refills at rate tokens per second up
+# to burst tokens. Callers of acquire in a lane wait while a caller in a
+# higher priority lane is waiting.
+class TokenBucket:
+
+    def __init__(self, rate, burst, lanes=LANES):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lanes = lanes
+        self.condition = threading.Condition()
+        self.waiting = dict((name, 0) for name in lanes)
+        self.granted = dict((name, 0) for name in lanes)
+        self.wait_seconds = dict((name, 0.0) for name in lanes)
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(float(self.burst),
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Takes cost tokens if there are enough, without waiting
+    def try_acquire(self, cost=1):
+        with self.condition:
+            self.refill()
+            if self.tokens < cost:
+                return False
+            self.tokens = self.tokens - cost
+            return True
+
+    # Waits for cost tokens and takes them. Returns the seconds waited.
+    def acquire(self, name=LANES[0], cost=1):
+        if self.rate <= 0:
+            return 0.0
+        start = time.time()
+        higher = self.lanes[:self.lanes.index(name)]
+
+        with self.condition:
+            self.waiting[name] = self.waiting[name] + 1
+            try:
+                while True:
+                    self.refill()
+                    ahead = any(self.waiting[other] for other in higher)
+                    if not ahead and self.tokens >= cost:
+                        self.tokens = self.tokens - cost
+                        break
+                    delay = (cost - self.tokens) / self.rate
+                    self.condition.wait(max(delay, 0.01))
+            finally:
+                self.waiting[name] = self.waiting[name] - 1
+                self.condition.notify_all()
+
+            waited = time.time() - start
+            self.granted[name] = self.granted[name] + 1
+            self.wait_seconds[name] = self.wait_seconds[name] + waited
+        return waited
+
+    def get_stats(self):
+        with self.condition:
+            self.refill()
+            return {'rate': self.rate,
+                    'burst': self.burst,
+                    'tokens': self.tokens,
+                    'lanes': dict((name, {'waiting': self.waiting[name],
+                                          'granted': self.granted[name],
+                                          'wait_seconds':
+                                              self.wait_seconds[name]})
+                                  for name in self.lanes)}
+
+HEADERS = {'Accept-Encoding': 'gzip, deflate',
+           'User-Agent': 'Exchange-Bot'}
+
+# Class to represent the latency of every request made to one URL
+class Latency:
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bytes = 0
+
+    def add(self, seconds, size):
+        self.count = self.count + 1
+        self.total = self.total + seconds
+        self.max = max(self.max, seconds)
+        self.bytes = self.bytes + size
+
+    def get_stats(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'retries': self.retries,
+                'avg': self.total / self.count if self.count else 0.0,
+                'max': self.max,
+                'bytes': self.bytes}
+
+# Class to represent the shared HTTP client. All requests go through one
+# session so that connections to CMC are kept alive and reused.
+class HttpClient:
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                              pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.limiter = TokenBucket(RATE, BURST)
+        self.lock = threading.Lock()
+        self.host_limits = dict()
+        self.latencies = dict()
+
+    def host_limit(self, host):
+        with self.lock:
+            try:
+                return self.host_limits[host]
+            except KeyError:
+                limit = threading.BoundedSemaphore(HOST_CONCURRENCY)
+                self.host_limits[host] = limit
+                return limit
+
+    def latency(self, url):
+        with self.lock:
+            try:
+                return self.latencies[url]
+            except KeyError:
+                latency = Latency()
+                self.latencies[url] = latency
+                return latency
+
+    # Gets url, retrying connection errors, timeouts and RETRY_STATUS
+    # responses with exponential backoff. Every attempt waits for a token of
+    # the rate limiter in the lane of the current thread. Returns the last
+    # response or raises the last error once the retries run out.
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        parts = urlsplit(url)
+        latency = self.latency(parts.scheme + '://' + parts.netloc +
+                               parts.path)
+        attempt = 0
+
+        while True:
+            waited = self.limiter.acquire(getLane())
+            if waited > 0.5:
+                tracing.log(logger, logging.DEBUG, 'rate limited', url=url,
+                            lane=getLane(), ms='{:.0f}'.format(waited * 1000))
+            start = time.time()
+            try:
+                with self.host_limit(parts.netloc):
+                    page = self.session.get(url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                with self.lock:
+                    latency.errors = latency.errors + 1
+                if attempt >= MAX_RETRIES:
+                    raise
+                tracing.log(logger, logging.WARNING, 'retrying', url=url,
+                            attempt=attempt + 1, error=e)
+            else:
+                with self.lock:
+                    latency.add(time.time() - start, len(page.content))
+                if page.status_code not in RETRY_STATUS or \
+                   attempt >= MAX_RETRIES:
+                    return page
+                tracing.log(logger, logging.WARNING, 'retrying', url=url,
+                            attempt=attempt + 1, status=page.status_code)
+
+            with self.lock:
+                latency.retries = latency.retries + 1
+            time.sleep(BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+            attempt = attempt + 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict((url, latency.get_stats())
+                        for url, latency in self.latencies.items())
+
+# Shared client used for every request to CMC
+client = HttpClient()
+
+def get(url, **kwargs):
+    return client.get(url, **kwargs)
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+
+# Prefix of every metric written in the Prometheus text format
+PREFIX = 'exchangebot_'
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0, 60.0)
+
+# Class to represent a latency histogram with fixed buckets
+class Histogram:
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i = i + 1
+        self.counts[i] = self.counts[i] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + value
+
+    # Estimates the q quantile (0 to 1) by interpolating inside its bucket
+    def quantile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i in range(len(self.counts)):
+            if i < len(self.buckets):
+                upper = self.buckets[i]
+            else:
+                return lower
+            if seen + self.counts[i] >= rank and self.counts[i] > 0:
+                return lower + (upper - lower) * (rank - seen) / self.counts[i]
+            seen = seen + self.counts[i]
+            lower = upper
+        return lower
+
+# Class to represent every metric recorded by the bot. Metrics are keyed by
+# name and a tuple of sorted (label, value) pairs.
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.counters = dict()
+        self.gauges = dict()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            try:
+                histogram = self.histograms[name][key]
+            except KeyError:
+                histogram = Histogram()
+                self.histograms.setdefault(name, dict())[key] = histogram
+            histogram.observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counters = self.counters.setdefault(name, dict())
+            counters[key] = counters.get(key, 0) + amount
+
+    # Sets a counter that is counted elsewhere, e.g. the evictions of a
+    # cache, to its current total
+    def set_counter(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.counters.setdefault(name, dict())[key] = value
+
+    def set_gauge(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.gauges.setdefault(name, dict())[key] = value
+
+    def get_counters(self, name):
+        with self.lock:
+            return dict(self.counters.get(name, {}))
+
+    def get_histograms(self, name):
+        with self.lock:
+            return dict(self.histograms.get(name, {}))
+
+# Shared registry used by the bot
+registry = Registry()
+
+# Class to time a block of code into a histogram e.g.
+# with Timer('scrape_seconds', scraper='updateCoin', phase='fetch'): ...
+class Timer:
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        registry.observe(self.name, time.time() - self.start, **self.labels)
+        return False
+
+# Wraps a Telegram command handler so its latency is recorded per command
+def timeCommand(command, handler):
+
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return handler(*args, **kwargs)
+        finally:
+            registry.observe('command_seconds', time.time() - start,
+                             command=command)
+
+    timed.__name__ = handler.__name__
+    return timed
+
+def formatLabels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(label + '="' + str(value).replace('"', '\\"') + '"'
+                          for label, value in labels) + '}'
+
+def formatNumber(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Returns every metric in the Prometheus text exposition format
+def toPrometheus(registry=registry):
+    lines = []
+    with registry.lock:
+        for name in sorted(registry.counters):
+            lines.append('# TYPE ' + PREFIX + name + ' counter')
+            for key, value in sorted(registry.counters[name].items()):
+                lines.append(PREFIX + name + formatLabels(key) + ' ' +
+                             formatNumber(value))
+
+        for name in sorted(registry.gauges):
+            lines.append('# TYPE ' + PREFIX + name + ' gauge')
+            for key, value in sorted(registry.gauges[name].items()):
+                lines.append(PREFIX + name + formatLabels(key) + ' ' +
+                             formatNumber(value))
+
+        for name in sorted(registry.histograms):
+            lines.append('# TYPE ' + PREFIX + name + ' histogram')
+            for key, histogram in sorted(registry.histograms[name].items()):
+                cumulative = 0
+                bounds = list(histogram.buckets) + [float('inf')]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative = cumulative + count
+                    lines.append(PREFIX + name + '_bucket' +
+                                 formatLabels(key, [('le',
+                                                     formatNumber(bound))]) +
+                                 ' ' + str(cumulative))
+                lines.append(PREFIX + name + '_sum' + formatLabels(key) + ' ' +
+                             formatNumber(histogram.sum))
+                lines.append(PREFIX + name + '_count' + formatLabels(key) +
+                             ' ' + str(histogram.count))
+    return '\n'.join(lines) + '\n'
+
+# Writes the metrics to path through a temporary file so that a scraper never
+# reads a partially written file
+def writePrometheus(path, registry=registry):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(toPrometheus(registry))
+    os.replace(temp_path, path)
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import functions
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Number of top ranked coins whose markets pages are prefetched after every
+# update of coin_database
+PREFETCH_TOP_N = 100
+
+# Maximum number of markets pages fetched at the same time
+PREFETCH_CONCURRENCY = 5
+
+# Maximum number of markets pages fetched per second across all workers
+PREFETCH_RATE = 2.0
+
+# Class to space out requests so that at most rate requests start per second
+class RateLimiter:
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Fetches and parses the markets page of one coin into coin_to_exchanges.
+# updateCoin is blocking so it runs on executor, coalesced with any user
+# triggered update of the same coin.
+async def prefetchCoin(coin, semaphore, limiter, executor, stats):
+    loop = asyncio.get_event_loop()
+
+    async with semaphore:
+        await limiter.wait()
+        try:
+            result = await loop.run_in_executor(executor,
+                                                functions.httpclient.runInLane,
+                                                'background',
+                                                functions.update_flight.do,
+                                                ('coin', coin),
+                                                functions.updateCoin,
+                                                coin,
+                                                functions.coin_to_exchanges)
+        except Exception as e:
+            tracing.log(logger, logging.WARNING, 'error prefetching',
+                        coin=coin, error=e)
+            result = False
+
+    if result is False:
+        stats['errors'] = stats['errors'] + 1
+    else:
+        stats['pages'] = stats['pages'] + 1
+
+# Prefetches the markets pages of coins concurrently
+async def prefetchCoins(coins, concurrency, rate):
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+    stats = {'pages': 0, 'errors': 0}
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        await asyncio.gather(*[prefetchCoin(coin,
+                                            semaphore,
+                                            limiter,
+                                            executor,
+                                            stats)
+                               for coin in coins])
+    return stats
+
+# Prefetches the markets pages of the top_n coins by rank and returns the
+# number of pages, errors, seconds taken and pages per second
+def prefetchTopCoins(top_n=PREFETCH_TOP_N,
+                     concurrency=PREFETCH_CONCURRENCY,
+                     rate=PREFETCH_RATE):
+    dbs = functions.databases
+    coins = [coin for coin in dbs.ranking[:top_n] if coin in dbs.coins]
+    tracing.log(logger, logging.INFO, 'prefetching', coins=len(coins))
+
+    start = time.time()
+    loop = asyncio.new_event_loop()
+    try:
+        stats = loop.run_until_complete(prefetchCoins(coins,
+                                                      concurrency,
+                                                      rate))
+    finally:
+        loop.close()
+
+    stats['seconds'] = time.time() - start
+    stats['pages_per_second'] = stats['pages'] / stats['seconds'] \
+        if stats['seconds'] > 0 else 0.0
+    tracing.log(logger, logging.INFO, 'prefetched', pages=stats['pages'],
+                errors=stats['errors'],
+                seconds='{:.2f}'.format(stats['seconds']),
+                pages_per_second='{:.2f}'.format(stats['pages_per_second']))
+    return stats
+
+# Runs prefetchTopCoins on a background thread unless one is already running
+prefetch_lock = threading.Lock()
+
+def startPrefetch():
+    if not prefetch_lock.acquire(False):
+        tracing.log(logger, logging.INFO, 'prefetch already running')
+        return False
+
+    def run():
+        try:
+            prefetchTopCoins()
+        finally:
+            prefetch_lock.release()
+
+    thread = threading.Thread(target=run, name='prefetch')
+    thread.daemon = True
+    thread.start()
+    return True
+
+# Serves the saved CMC pages in fixtures over a local HTTP server and
+# prefetches against it
+def runAgainstFixtures(fixtures_dir, top_n, concurrency, rate):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class FixtureServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path.startswith('/all/'):
+                name = 'all.html'
+            elif self.path.startswith('/currencies/'):
+                name = 'markets.html'
+            elif self.path.startswith('/exchanges/volume/'):
+                name = 'exchanges.html'
+            else:
+                name = 'exchange.html'
+            with open(os.path.join(fixtures_dir, name), 'rb') as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = FixtureServer(('127.0.0.1', 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    # The local server does not need to be protected by the CMC rate limit
+    functions.httpclient.client.limiter.rate = 0
+
+    try:
+        functions.CMC_URL = 'http://127.0.0.1:' + str(server.server_port)
+        functions.updateCoinDB()
+        return prefetchTopCoins(top_n, concurrency, rate)
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+
+    # Usage: python3 prefetch.py [top_n] [concurrency] [rate]
+    logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s',
+                        level=tracing.LOG_LEVEL)
+    args = sys.argv[1:]
+    runAgainstFixtures(functions.extractor.FIXTURES_DIR,
+                       int(args[0]) if len(args) > 0 else PREFETCH_TOP_N,
+                       int(args[1]) if len(args) > 1 else PREFETCH_CONCURRENCY,
+                       float(args[2]) if len(args) > 2 else 1000.0)
@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import accumulation
+import functions
+import metrics
+import prefetch
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Days of history every coin is scored over
+SCAN_DAYS = 30
+
+# Coins per work unit. The historical data pages of a unit are downloaded on
+# threads and then parsed and analysed together in one worker process.
+SCAN_CHUNK_SIZE = 25
+
+# Worker processes for parsing and analysing, and the limits on downloading
+# the pages, like the prefetcher
+SCAN_PROCESSES = os.cpu_count() or 2
+SCAN_CONCURRENCY = 4
+SCAN_RATE = 2.0
+
+# The bot runs scans on a thread next to many others, so the worker processes
+# are started from a clean server process instead of forking the bot, which
+# could copy a lock held by another thread and every cache along with it
+SCAN_START_METHOD = 'forkserver' \
+    if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Seconds between scheduled scans
+SCAN_INTERVAL = 21600
+
+# Class to represent the result of a scan. ranking is a list of
+# (coin, score, analyse results) tuples with the highest score first.
+class ScanResult:
+
+    def __init__(self, ranking, days, coins, errors, seconds):
+        self.time_of_update = time.time()
+        self.ranking = ranking
+        self.days = days
+        self.coins = coins
+        self.errors = errors
+        self.seconds = seconds
+
+    def age(self):
+        return time.time() - self.time_of_update
+
+# Latest completed scan and the progress of the running one
+latest = None
+progress = {'running': False, 'done': 0, 'total': 0, 'errors': 0,
+            'start': 0.0}
+scan_lock = threading.Lock()
+
+# Returns the accumulation score of one coin: the factor over the whole window
+# if its volume went up, None if it did not or the factor is undefined
+def getScore(results):
+    factor = results.get('factor', math.nan)
+    if math.isnan(factor) or not results.get('volume_change', 0) > 0:
+        return None
+    return abs(factor)
+
+# Runs func(*args) on a process of pool and returns its result to the event
+# loop. multiprocessing pools only report back through callbacks, which are
+# called on a thread of the pool.
+def runInPool(loop, pool, func, *args):
+    future = asyncio.Future(loop=loop)
+
+    def done(result):
+        if not future.done():
+            future.set_result(result)
+
+    def failed(error):
+        if not future.done():
+            future.set_exception(error)
+
+    pool.apply_async(func, args,
+                     callback=lambda result:
+                         loop.call_soon_threadsafe(done, result),
+                     error_callback=lambda error:
+                         loop.call_soon_threadsafe(failed, error))
+    return future
+
+# Downloads the historical data pages of chunk one after the other, then
+# analyses them in a worker process
+async def scanChunk(chunk, days, semaphore, limiter, threads, processes):
+    loop = asyncio.get_event_loop()
+    pages = []
+
+    for coin in chunk:
+        async with semaphore:
+            await limiter.wait()
+            try:
+                html = await loop.run_in_executor(
+                    threads, functions.httpclient.runInLane, 'background',
+                    functions.getHtml, 'history', coin, days)
+            except Exception as e:
+                tracing.log(logger, logging.WARNING, 'error fetching history',
+                            coin=coin, error=e)
+                html = False
+        pages.append((coin, html))
+
+    results, errors = await runInPool(loop, processes,
+                                      accumulation.analysePages, pages)
+    progress['done'] = progress['done'] + len(chunk)
+    progress['errors'] = progress['errors'] + errors
+    metrics.registry.set_gauge('scan_coins_done', progress['done'])
+    tracing.log(logger, logging.INFO, 'scan progress', done=progress['done'],
+                total=progress['total'], errors=progress['errors'])
+    return results
+
+async def scanChunks(chunks, days, processes, concurrency, rate):
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = prefetch.RateLimiter(rate)
+
+    context = multiprocessing.get_context(SCAN_START_METHOD)
+    with ThreadPoolExecutor(max_workers=concurrency) as threads, \
+         context.Pool(processes) as process_pool:
+        return await asyncio.gather(*[scanChunk(chunk,
+                                                days,
+                                                semaphore,
+                                                limiter,
+                                                threads,
+                                                process_pool)
+                                      for chunk in chunks])
+
+# Scores coins, every coin in the coin database by default, and stores the
+# ranking in latest
+def scan(coins=None, days=SCAN_DAYS, processes=SCAN_PROCESSES,
+         concurrency=SCAN_CONCURRENCY, rate=SCAN_RATE,
+         chunk_size=SCAN_CHUNK_SIZE):
+    global latest
+
+    if coins is None:
+        dbs = functions.databases
+        coins = [coin for coin in dbs.ranking if coin in dbs.coins]
+    chunks = [coins[i:i + chunk_size]
+              for i in range(0, len(coins), chunk_size)]
+    progress.update({'running': True, 'done': 0, 'total': len(coins),
+                     'errors': 0, 'start': time.time()})
+    metrics.registry.set_gauge('scan_coins_total', len(coins))
+    tracing.log(logger, logging.INFO, 'scanning', coins=len(coins),
+                chunks=len(chunks), processes=processes)
+
+    loop = asyncio.new_event_loop()
+    try:
+        with metrics.Timer('scan_seconds'):
+            chunk_results = loop.run_until_complete(
+                scanChunks(chunks, days, processes, concurrency, rate))
+    finally:
+        loop.close()
+        progress['running'] = False
+
+    ranking = []
+    for results in chunk_results:
+        for coin, result in results:
+            score = getScore(result)
+            if score is not None:
+                ranking.append((coin, score, result))
+    ranking.sort(key=lambda entry: entry[1], reverse=True)
+
+    latest = ScanResult(ranking, days, len(coins), progress['errors'],
+                        time.time() - progress['start'])
+    tracing.log(logger, logging.INFO, 'scan complete', coins=len(coins),
+                ranked=len(ranking), errors=latest.errors,
+                seconds='{:.1f}'.format(latest.seconds))
+    return latest
+
+# Runs scan on a background thread unless one is already running
+def startScan():
+    if not scan_lock.acquire(False):
+        tracing.log(logger, logging.INFO, 'scan already running')
+        return False
+
+    def run():
+        try:
+            scan()
+        except Exception as e:
+            tracing.log(logger, logging.ERROR, 'scan failed', error=e)
+        finally:
+            scan_lock.release()
+
+    thread = threading.Thread(target=run, name='scan')
+    thread.daemon = True
+    thread.start()
+    return True
+
+# Scans the coins of the benchmark fixtures offline
+def runAgainstFixtures(version, coins, processes):
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                    'benchmarks'))
+    import bench
+
+    server = bench.FixtureServer(version)
+    original_get = functions.httpclient.get
+    functions.httpclient.get = server.get
+    try:
+        functions.updateCoinDB()
+        result = scan(functions.databases.ranking[:coins], processes=processes,
+                      rate=0)
+    finally:
+        functions.httpclient.get = original_get
+
+    print("Scanned " + str(result.coins) + " coins with " +
+          str(result.errors) + " errors in " +
+          '{:.2f}'.format(result.seconds) + "s")
+    for coin, score, results in result.ranking[:10]:
+        print(coin + ": " + '{:,.2f}'.format(score))
+    return result
+
+if __name__ == "__main__":
+
+    # Usage: python3 scanner.py [coins] [processes]
+    logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s',
+                        level=tracing.LOG_LEVEL)
+    args = sys.argv[1:]
+    runAgainstFixtures('v1',
+                       int(args[0]) if len(args) > 0 else 1600,
+                       int(args[1]) if len(args) > 1 else SCAN_PROCESSES)
@@ -23,9 +23,9 @@ rootdir = os.path.abspath(os.path.dirname(__file__))
 links = []
 requires = []
 
-# Python 3.4 and above
-if sys.version_info < (3, 4, 0, 'final', 0):
-	raise SystemExit('Python 3.4 or later is required!')
+# Python 3.5 and above
+if sys.version_info < (3, 5, 0, 'final', 0):
+	raise SystemExit('Python 3.5 or later is required!')
 
 # Opening requirements.txt to obtain a list of libraries needed
 
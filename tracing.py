@@ -0,0 +1,130 @@
+import cProfile
+import logging
+import os
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Level of the bot's log messages, e.g. EXCHANGEBOT_LOG_LEVEL=DEBUG also logs
+# cache lookups and the timed spans of every command
+LOG_LEVEL = os.environ.get('EXCHANGEBOT_LOG_LEVEL', 'INFO').upper()
+
+# Fraction of commands (0 to 1) that are run under cProfile. The stats of each
+# profiled command are saved to PROFILE_DIR and can be read with pstats.
+PROFILE_RATE = float(os.environ.get('EXCHANGEBOT_PROFILE_RATE', '0'))
+PROFILE_DIR = 'profiles'
+
+# Only one command is profiled at a time since cProfile cannot profile
+# several threads at once
+profile_lock = threading.Lock()
+
+# Id of the command being handled by the current thread
+context = threading.local()
+
+def newRequestId():
+    return '{:08x}'.format(random.getrandbits(32))
+
+def getRequestId():
+    return getattr(context, 'request_id', '-')
+
+# Context manager to tag every log message of the current thread with
+# request_id, e.g. background refreshes keep the id of the command that
+# scheduled them
+class requestContext:
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def __enter__(self):
+        self.previous = getRequestId()
+        context.request_id = self.request_id
+        return self.request_id
+
+    def __exit__(self, *exc):
+        context.request_id = self.previous
+        return False
+
+# Logging filter that adds the request id to records so that the format can
+# include %(request_id)s
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = getRequestId()
+        return True
+
+# Logs event followed by fields as key=value pairs. Nothing is formatted unless
+# level is enabled.
+def log(logger, level, event, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event + ''.join(' ' + key + '=' + str(fields[key])
+                                          for key in sorted(fields)))
+
+# Context manager to log how long a step of a command took at DEBUG level e.g.
+# with span('fetch', coin='BTC'): ...
+class span:
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        fields = dict(self.fields)
+        if exc[0] is not None:
+            fields['error'] = exc[0].__name__
+        log(logger, logging.DEBUG, 'span ' + self.name,
+            ms='{:.1f}'.format((time.time() - self.start) * 1000), **fields)
+        return False
+
+def setProfileRate(rate):
+    global PROFILE_RATE
+    PROFILE_RATE = min(max(rate, 0.0), 1.0)
+    return PROFILE_RATE
+
+# Runs handler under cProfile and saves its stats as
+# PROFILE_DIR/<command>-<time>-<request id>.prof
+def profileCommand(command, handler, *args, **kwargs):
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(handler, *args, **kwargs)
+    finally:
+        path = os.path.join(PROFILE_DIR,
+                            command + '-' + time.strftime('%Y%m%d%H%M%S') +
+                            '-' + getRequestId() + '.prof')
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(path)
+        except (IOError, OSError) as e:
+            log(logger, logging.WARNING, 'profile not saved', path=path,
+                error=e)
+        else:
+            log(logger, logging.INFO, 'profile saved', path=path)
+
+# Wraps a Telegram command handler so that every call gets a request id, its
+# start and end are logged and a PROFILE_RATE fraction of calls is profiled
+def traceCommand(command, handler):
+
+    def traced(*args, **kwargs):
+        with requestContext(newRequestId()):
+            log(logger, logging.INFO, 'command', command=command)
+            start = time.time()
+            try:
+                if PROFILE_RATE > 0 and random.random() < PROFILE_RATE and \
+                   profile_lock.acquire(False):
+                    try:
+                        return profileCommand(command, handler,
+                                              *args, **kwargs)
+                    finally:
+                        profile_lock.release()
+                return handler(*args, **kwargs)
+            finally:
+                log(logger, logging.INFO, 'command done', command=command,
+                    ms='{:.1f}'.format((time.time() - start) * 1000))
+
+    traced.__name__ = handler.__name__
+    return traced
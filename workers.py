@@ -0,0 +1,295 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpclient
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Commands run on a pool of COMMAND_WORKERS threads instead of the dispatcher
+# thread of python-telegram-bot, so one slow scrape only holds up its own
+# reply. At most COMMAND_QUEUE_LIMIT commands wait for a free worker, any more
+# are turned away with a busy reply.
+COMMAND_WORKERS = int(os.environ.get('EXCHANGEBOT_WORKERS', '8'))
+COMMAND_QUEUE_LIMIT = 32
+
+# A command that is still running after ACK_AFTER seconds gets a short working
+# reply, and one still running after its deadline gets a timed out reply. Its
+# later replies are dropped since the user has already been told.
+ACK_AFTER = 2.0
+DEFAULT_DEADLINE = 30.0
+COMMAND_DEADLINES = {'analyse': 60.0, 'updateDB': 600.0}
+
+# Commands that send their own working reply
+NO_ACK_COMMANDS = set(['updateDB'])
+
+# Every chat may run CHAT_RATE commands per second, or CHAT_BURST at once
+# after a quiet period. In a group chat every member may also only run
+# USER_RATE commands per second, so one member cannot use up the quota of the
+# whole group. Commands that start a lot of scraping cost more.
+CHAT_RATE = 0.2
+CHAT_BURST = 6
+USER_RATE = 0.1
+USER_BURST = 6
+COMMAND_COSTS = {'updateDB': 6, 'analyse': 2}
+
+ACK_TEXT = 'Working on it...'
+BUSY_TEXT = 'The bot is busy right now, please try again in a moment.'
+TIMEOUT_TEXT = 'Sorry, that took too long. Please try again later.'
+THROTTLED_TEXT = 'You are sending commands too quickly, please wait a moment.'
+
+# Class to run callbacks at given times on a single thread, used for the
+# working replies and deadlines of every command
+class Watchdog:
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.timers = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        with self.condition:
+            heapq.heappush(self.timers, (time.time() + delay,
+                                         next(self.counter),
+                                         callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='watchdog')
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.timers or self.timers[0][0] > time.time():
+                    if self.timers:
+                        self.condition.wait(self.timers[0][0] - time.time())
+                    else:
+                        self.condition.wait()
+                callback = heapq.heappop(self.timers)[2]
+            try:
+                callback()
+            except Exception as e:
+                tracing.log(logger, logging.ERROR, 'watchdog callback failed',
+                            error=e)
+
+# Class to stand in for the bot inside a command that is run on the pool.
+# Messages sent after the command has timed out are dropped.
+class CommandBot:
+
+    def __init__(self, bot, command):
+        self.bot = bot
+        self.command = command
+        self.lock = threading.Lock()
+        self.replied = False
+        self.timed_out = False
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+    def send_message(self, *args, **kwargs):
+        with self.lock:
+            if self.timed_out:
+                tracing.log(logger, logging.INFO, 'dropping late reply',
+                            command=self.command)
+                return None
+            self.replied = True
+        return self.bot.send_message(*args, **kwargs)
+
+    # Sends text as a reply to update unless the command has already replied
+    # or timed out. Returns True if it was sent.
+    def notify(self, update, text, timeout=False):
+        with self.lock:
+            if self.timed_out or (self.replied and not timeout):
+                return False
+            if timeout:
+                self.timed_out = True
+        message = update.message
+        try:
+            self.bot.send_message(chat_id=message.chat_id,
+                                  text=text,
+                                  reply_to_message_id=message.message_id)
+        except Exception as e:
+            tracing.log(logger, logging.WARNING, 'error notifying',
+                        command=self.command, error=e)
+            return False
+        return True
+
+# Class to represent the command quotas of every chat, and of every member of
+# a group chat, as token buckets. Buckets are keyed by chat id for chats and
+# by (chat id, user id) for members. Buckets that have refilled are dropped
+# once there are more than max_buckets.
+class ChatQuotas:
+
+    def __init__(self, rate=CHAT_RATE, burst=CHAT_BURST, user_rate=USER_RATE,
+                 user_burst=USER_BURST, max_buckets=10000):
+        self.rate = rate
+        self.burst = burst
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+        self.buckets = dict()
+
+    def get_bucket(self, key, rate, burst):
+        try:
+            return self.buckets[key]
+        except KeyError:
+            if len(self.buckets) >= self.max_buckets:
+                self.prune()
+            bucket = httpclient.TokenBucket(rate, burst)
+            self.buckets[key] = bucket
+            return bucket
+
+    # Takes the cost of command from the quota of chat_id and, in a group
+    # chat, from the quota of user_id in it. Returns False without taking
+    # anything if either has run out.
+    def admit(self, chat_id, user_id, command):
+        cost = COMMAND_COSTS.get(command, 1)
+        with self.lock:
+            buckets = [self.get_bucket(chat_id, self.rate, self.burst)]
+            if user_id is not None and user_id != chat_id:
+                buckets.append(self.get_bucket((chat_id, user_id),
+                                               self.user_rate,
+                                               self.user_burst))
+            for bucket in buckets:
+                bucket.refill()
+                if bucket.tokens < cost:
+                    return False
+            for bucket in buckets:
+                bucket.tokens = bucket.tokens - cost
+        return True
+
+    def prune(self):
+        for key in list(self.buckets):
+            bucket = self.buckets[key]
+            bucket.refill()
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
+
+# Class to represent the bounded pool that commands are run on
+class CommandPool:
+
+    def __init__(self, workers=COMMAND_WORKERS,
+                 queue_limit=COMMAND_QUEUE_LIMIT):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.watchdog = Watchdog()
+        self.quotas = ChatQuotas()
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.rejected = 0
+        self.throttled = 0
+        self.timed_out = 0
+
+    def get_stats(self):
+        with self.lock:
+            return {'workers': self.workers,
+                    'queued': self.queued,
+                    'running': self.running,
+                    'rejected': self.rejected,
+                    'throttled': self.throttled,
+                    'timed_out': self.timed_out}
+
+    # Takes the cost of command from the quotas of the chat of update and of
+    # its sender. Returns False if either has run out.
+    def admit(self, command, update):
+        message = update.message
+        user_id = message.from_user.id if message.from_user else None
+        if self.quotas.admit(message.chat_id, user_id, command):
+            return True
+        with self.lock:
+            self.throttled = self.throttled + 1
+        metrics.registry.increment('commands_throttled_total',
+                                   command=command)
+        return False
+
+    # Queues handler(bot, update, *args) on the pool. Returns False without
+    # queueing it if queue_limit commands are already waiting.
+    def submit(self, command, handler, bot, update, *args, **kwargs):
+        with self.lock:
+            if self.queued >= self.queue_limit:
+                self.rejected = self.rejected + 1
+                metrics.registry.increment('commands_rejected_total',
+                                           command=command)
+                return False
+            self.queued = self.queued + 1
+
+        command_bot = CommandBot(bot, command)
+        deadline = COMMAND_DEADLINES.get(command, DEFAULT_DEADLINE)
+        done = threading.Event()
+        submitted = time.time()
+
+        def run():
+            with self.lock:
+                self.queued = self.queued - 1
+                self.running = self.running + 1
+            metrics.registry.observe('command_queue_seconds',
+                                     time.time() - submitted,
+                                     command=command)
+            try:
+                if not command_bot.timed_out:
+                    handler(command_bot, update, *args, **kwargs)
+            except Exception as e:
+                tracing.log(logger, logging.ERROR, 'command failed',
+                            command=command, error=e)
+            finally:
+                done.set()
+                with self.lock:
+                    self.running = self.running - 1
+
+        def acknowledge():
+            if not done.is_set():
+                command_bot.notify(update, ACK_TEXT)
+
+        def expire():
+            if not done.is_set() and \
+               command_bot.notify(update, TIMEOUT_TEXT, timeout=True):
+                with self.lock:
+                    self.timed_out = self.timed_out + 1
+                metrics.registry.increment('commands_timed_out_total',
+                                           command=command)
+                tracing.log(logger, logging.WARNING, 'command timed out',
+                            command=command, deadline=deadline)
+
+        self.executor.submit(run)
+        if command not in NO_ACK_COMMANDS and ACK_AFTER < deadline:
+            self.watchdog.schedule(ACK_AFTER, acknowledge)
+        self.watchdog.schedule(deadline, expire)
+        return True
+
+# Shared pool that the slow commands are run on
+pool = CommandPool()
+
+# Wraps a Telegram command handler so that it runs on pool instead of the
+# dispatcher thread
+def offloadCommand(command, handler):
+
+    def offloaded(bot, update, *args, **kwargs):
+        if not pool.admit(command, update):
+            tracing.log(logger, logging.INFO, 'command throttled',
+                        command=command, chat=update.message.chat_id,
+                        user=getattr(update.message.from_user, 'id', None))
+            bot.send_message(chat_id=update.message.chat_id,
+                             text=THROTTLED_TEXT,
+                             reply_to_message_id=update.message.message_id)
+            return
+        if not pool.submit(command, handler, bot, update, *args, **kwargs):
+            tracing.log(logger, logging.WARNING, 'command rejected',
+                        command=command, queued=pool.queue_limit)
+            bot.send_message(chat_id=update.message.chat_id,
+                             text=BUSY_TEXT,
+                             reply_to_message_id=update.message.message_id)
+
+    offloaded.__name__ = handler.__name__
+    return offloaded